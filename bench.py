@@ -0,0 +1,322 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import cv2
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+from rich import box
+from rich.markup import escape
+import main
+import replay
+
+CORPUS_PATH = os.path.join("bench", "corpus")
+BASELINE_PATH = os.path.join("bench", "baseline.json")
+THRESHOLDS = {"disconnect": 0.9, "home": 0.9}
+CONVERT_SAMPLES = ["43,381", "4,840", "1.7M", "1.6M", "850K", "2.4B", "12.5K", "", "KMB"]
+LOCATION_TOLERANCE = 5
+SYNTHETIC_WIDTHS = (960, 640)
+REFERENCE_ENGINE = "full"
+NOISE_FLOOR_MS = 0.5
+GATHER_CYCLES = 3
+CORPUS_VERSION = 2
+CORPUS_BACKGROUND = "scout_management.png"
+CORPUS_FLOWS = (("gather", replay.SYNTHETIC_GATHER), ("fog", replay.SYNTHETIC_FOG),
+                ("disconnect", {"states": {"disconnect": {"taps": {"disconnect": None, "confirm": None}}}}))
+CORPUS_POSITIONS = {"disconnect": (252, 200), "confirm": (389, 300)}
+
+console = Console(width=120)
+
+def peak_rss_mb():
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+        except (ImportError, AttributeError):
+            return None
+
+def measure(func, calls):
+    samples = []
+    cpu_start = time.process_time()
+    for call in calls:
+        start = time.perf_counter()
+        func(*call)
+        samples.append(time.perf_counter() - start)
+    cpu = (time.process_time() - cpu_start) / len(samples)
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000
+    return {"p50_ms": round(float(p50), 3), "p95_ms": round(float(p95), 3), "p99_ms": round(float(p99), 3),
+            "cpu_ms": round(cpu * 1000, 3), "samples": len(samples), "peak_rss_mb": peak_rss_mb()}
+
+def load_corpus(path):
+    with open(os.path.join(path, "labels.json"), encoding="utf-8") as f:
+        spec = json.load(f)
+    frames = []
+    for name, entry in spec["frames"].items():
+        image = cv2.imread(os.path.join(path, name))
+        if image is None:
+            raise FileNotFoundError(name)
+        frames.append((name, main.Frame(image), entry))
+    return spec["version"], frames
+
+def synthetic_corpus():
+    frames = []
+    for spec in (replay.SYNTHETIC_GATHER, replay.SYNTHETIC_FOG):
+        scenario = replay.Scenario.synthetic(spec)
+        for name, state in scenario.states.items():
+            for width in SYNTHETIC_WIDTHS:
+                scale = width / state.image.shape[1]
+                image = state.image if scale == 1 else cv2.resize(state.image, None, fx=scale, fy=scale,
+                                                                  interpolation=cv2.INTER_AREA)
+                present = {template: [round((x + w / 2) * scale), round((y + h / 2) * scale)]
+                           for template, (x, y, w, h), _, _ in state.targets}
+                frames.append((f"synthetic/{name}@{width}", main.Frame(image, f"synthetic@{width}"),
+                               {"present": present}))
+    return frames
+
+def draw_resources(image, resources):
+    h, w, _ = image.shape
+    x1, x2 = int(w * 0.63), int(w * 0.92)
+    start_y, row_height = int(h * 0.33), int(h * 0.095)
+    cv2.rectangle(image, (x1, start_y), (x2, start_y + row_height * len(main.RESOURCE_KEYS)), (40, 32, 24), -1)
+    for i, key in enumerate(main.RESOURCE_KEYS):
+        y = start_y + i * row_height + int(row_height * 0.75)
+        cv2.putText(image, resources[key], (x1 + 10, y), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (255, 255, 255), 2, cv2.LINE_AA)
+
+def compose_corpus(path):
+    main.templates.load()
+    with open(os.path.join(path, "labels.json"), encoding="utf-8") as f:
+        spec = json.load(f)
+    background = cv2.imread(os.path.join(path, CORPUS_BACKGROUND))
+    if background is None:
+        raise FileNotFoundError(CORPUS_BACKGROUND)
+    base = spec["frames"][CORPUS_BACKGROUND]
+    frames = {CORPUS_BACKGROUND: base}
+    for flow, flow_spec in CORPUS_FLOWS:
+        for screen, entry in flow_spec["states"].items():
+            image = background.copy()
+            present = dict(base["present"])
+            for name in entry["taps"]:
+                template = main.templates.get(name)
+                if name in present:
+                    x, y = present[name][0] - template.width // 2, present[name][1] - template.height // 2
+                else:
+                    x, y = CORPUS_POSITIONS.get(name) or replay.SYNTHETIC_POSITIONS[name]
+                image[y:y + template.height, x:x + template.width] = template.color
+                present[name] = [x + template.width // 2, y + template.height // 2]
+            label = {"screen": screen, "composed": True, "present": present}
+            if screen == "resources" and (resources := flow_spec.get("resources")):
+                draw_resources(image, resources)
+                label["resources"] = resources
+            name = f"{flow}_{screen}.png"
+            cv2.imwrite(os.path.join(path, name), image)
+            frames[name] = label
+    with open(os.path.join(path, "labels.json"), "w", encoding="utf-8") as f:
+        text = json.dumps({"version": CORPUS_VERSION, "frames": frames}, indent=4, ensure_ascii=False)
+        f.write(re.sub(r"\[\s+(\d+),\s+(\d+)\s+\]", r"[\1, \2]", text) + "\n")
+    console.print(f"Đã tạo {len(frames) - 1} ảnh trong {path}")
+
+def check_ocr(frames):
+    labelled = [(name, frame, entry["resources"]) for name, frame, entry in frames if "resources" in entry]
+    ocr = {"fields": 0, "correct": 0, "errors": []}
+    try:
+        for frame_name, frame, expected in labelled:
+            values = main.ocr_resources_auto(frame)
+            for key, text in expected.items():
+                ocr["fields"] += 1
+                if main.convert_to_number(values.get(key) or "") == main.convert_to_number(text):
+                    ocr["correct"] += 1
+                else:
+                    ocr["errors"].append(f"{frame_name}: {key} đọc {values.get(key)!r}, nhãn {text!r}")
+    except Exception as e:
+        console.print(f"[yellow]Bỏ qua kiểm tra OCR: {escape(str(e))}[/yellow]")
+        return None
+    return ocr
+
+def synthetic_hit(template, frame):
+    image = frame.image.copy()
+    if region := template.scaled_region(frame):
+        x, y = region[0], region[1]
+    else:
+        x, y = (frame.width - template.width) // 2, (frame.height - template.height) // 2
+    image[y:y + template.height, x:x + template.width] = template.color
+    return main.Frame(image), (x + template.width // 2, y + template.height // 2)
+
+def cold_find(name, frame):
+    main.match_cache.entries.clear()
+    return main.find_image(name, frame, THRESHOLDS.get(name, 0.85))
+
+def check_accuracy(frames):
+    accuracy = {"true_positive": 0, "false_positive": 0, "false_negative": 0, "true_negative": 0, "errors": []}
+    for frame_name, frame, entry in frames:
+        present = entry.get("present", {})
+        for name in sorted(main.templates.templates):
+            found = cold_find(name, frame)
+            expected = present.get(name)
+            if found and expected:
+                if max(abs(found[0] - expected[0]), abs(found[1] - expected[1])) <= LOCATION_TOLERANCE:
+                    accuracy["true_positive"] += 1
+                else:
+                    accuracy["false_positive"] += 1
+                    accuracy["errors"].append(f"{frame_name}: {name} ở {found}, nhãn {expected}")
+            elif found:
+                accuracy["false_positive"] += 1
+                accuracy["errors"].append(f"{frame_name}: {name} nhận nhầm ở {found}")
+            elif expected:
+                accuracy["false_negative"] += 1
+                accuracy["errors"].append(f"{frame_name}: không tìm thấy {name}")
+            else:
+                accuracy["true_negative"] += 1
+    return accuracy
+
+def compare_engines(frames):
+    engine = main.MATCH_ENGINE
+    accuracy = {}
+    try:
+        for name in (REFERENCE_ENGINE, engine):
+            main.MATCH_ENGINE = name
+            main.device_scales.clear()
+            start = time.perf_counter()
+            accuracy[name] = check_accuracy(frames)
+            accuracy[name]["seconds"] = round(time.perf_counter() - start, 3)
+    finally:
+        main.MATCH_ENGINE = engine
+        main.device_scales.clear()
+    return accuracy
+
+def run_benchmarks(frames, repeat, skip_flow=False):
+    results = {}
+    for name in sorted(main.templates.templates):
+        template = main.templates.get(name)
+        hits = [(name, frame) for _, frame, entry in frames if name in entry.get("present", {})]
+        misses = [(name, frame) for _, frame, entry in frames if name not in entry.get("present", {})]
+        if not hits:
+            hits = [(name, synthetic_hit(template, frames[0][1])[0])]
+        results[f"find_image[{name}] hit"] = measure(cold_find, (hits * repeat)[:max(repeat, len(hits))])
+        if misses:
+            results[f"find_image[{name}] miss"] = measure(cold_find, (misses * repeat)[:max(repeat, len(misses))])
+
+    try:
+        calls = [(frame,) for _, frame, entry in frames if "resources" in entry] or [(frame,) for _, frame, _ in frames]
+        results["ocr_resources_auto"] = measure(main.ocr_resources_auto, (calls * repeat)[:max(repeat, len(calls))])
+    except Exception as e:
+        console.print(f"[yellow]Bỏ qua ocr_resources_auto: {escape(str(e))}[/yellow]")
+
+    calls = [(text,) for text in CONVERT_SAMPLES]
+    results["convert_to_number"] = measure(main.convert_to_number, calls * repeat)
+
+    if not skip_flow:
+        scenario = replay.Scenario.synthetic(replay.SYNTHETIC_GATHER, latency=0.05)
+        failed = []
+        def gather_cycle():
+            if replay.replay_flow(scenario, "gather", marches=1, quiet=True)["done"] != 1:
+                failed.append(True)
+        results["gather_cycle"] = measure(gather_cycle, [()] * GATHER_CYCLES)
+        if failed:
+            console.print(f"[red]gather_cycle không gửi được đạo quân ở {len(failed)}/{GATHER_CYCLES} lượt![/red]")
+            results["gather_cycle"]["failed"] = True
+    return results
+
+def compare(results, accuracy, engines, ocr, baseline, tolerance):
+    regressions = []
+    if ocr and ocr["correct"] < baseline.get("ocr", {}).get("correct", 0):
+        regressions.append(f"ocr: {ocr['correct']}/{ocr['fields']} < {baseline['ocr']['correct']}")
+    reference = engines[REFERENCE_ENGINE]
+    for name, current in engines.items():
+        for key in ("false_positive", "false_negative"):
+            if current[key] > reference[key]:
+                regressions.append(f"engine {name}: {key} {current[key]} > {REFERENCE_ENGINE} {reference[key]}")
+    for case, current in results.items():
+        if current.get("failed"):
+            regressions.append(f"{case}: thất bại")
+        old = baseline.get("results", {}).get(case)
+        if not old:
+            continue
+        limit = old["p50_ms"] * (1 + tolerance)
+        if current["p50_ms"] > limit and current["p50_ms"] - old["p50_ms"] > NOISE_FLOOR_MS:
+            regressions.append(f"{case}: p50 {current['p50_ms']:.2f}ms > {old['p50_ms']:.2f}ms")
+    old_accuracy = baseline.get("accuracy", {})
+    for key in ("false_positive", "false_negative"):
+        if key in old_accuracy and accuracy[key] > old_accuracy[key]:
+            regressions.append(f"accuracy: {key} {accuracy[key]} > {old_accuracy[key]}")
+    return regressions
+
+def print_report(results, accuracy, engines, ocr, baseline):
+    table = Table(title="ROK bot benchmark", box=box.SIMPLE)
+    for column in ("case", "p50 ms", "p95 ms", "p99 ms", "cpu ms", "n", "baseline p50"):
+        table.add_column(column, justify="left" if column == "case" else "right")
+    for case, r in results.items():
+        old = baseline.get("results", {}).get(case)
+        table.add_row(escape(case), f"{r['p50_ms']:.2f}", f"{r['p95_ms']:.2f}", f"{r['p99_ms']:.2f}",
+                      f"{r['cpu_ms']:.2f}", str(r["samples"]), f"{old['p50_ms']:.2f}" if old else "-")
+    console.print(table)
+    rss = peak_rss_mb()
+    console.print(f"Peak RSS: {rss:.1f} MB" if rss is not None else "Peak RSS: n/a")
+    console.print(f"Accuracy: TP {accuracy['true_positive']} | FP {accuracy['false_positive']} | "
+                  f"FN {accuracy['false_negative']} | TN {accuracy['true_negative']}")
+    for error in accuracy["errors"]:
+        console.print(f"  [yellow]{escape(error)}[/yellow]")
+    if ocr:
+        console.print(f"OCR: {ocr['correct']}/{ocr['fields']} giá trị đúng")
+        for error in ocr["errors"]:
+            console.print(f"  [yellow]{escape(error)}[/yellow]")
+    for name, engine in engines.items():
+        console.print(f"Engine {name}: TP {engine['true_positive']} | FP {engine['false_positive']} | "
+                      f"FN {engine['false_negative']} | TN {engine['true_negative']} | {engine['seconds']:.2f}s")
+
+def main_bench(args):
+    main.templates.load()
+    if args.compose_corpus:
+        compose_corpus(args.corpus)
+        return True
+    version, frames = load_corpus(args.corpus)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("corpus_version") != version:
+            console.print("[yellow]Baseline dùng phiên bản corpus khác, bỏ qua so sánh.[/yellow]")
+            baseline = {}
+
+    accuracy = check_accuracy(frames)
+    engines = compare_engines(frames + synthetic_corpus())
+    ocr = check_ocr(frames)
+    results = run_benchmarks(frames, args.repeat, args.skip_flow)
+    print_report(results, accuracy, engines, ocr, baseline)
+    report = {"corpus_version": version, "results": results,
+              "accuracy": {k: v for k, v in accuracy.items() if k != "errors"},
+              "engines": {name: {k: v for k, v in engine.items() if k != "errors"} for name, engine in engines.items()}}
+    if ocr:
+        report["ocr"] = {k: v for k, v in ocr.items() if k != "errors"}
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+        console.print(f"Đã lưu baseline vào {args.baseline}")
+        return True
+
+    regressions = compare(results, accuracy, engines, ocr, baseline, args.tolerance)
+    for regression in regressions:
+        console.print(f"[red]Chậm hơn baseline: {escape(regression)}[/red]")
+    return not regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark template matching, OCR and the gather flow")
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--skip-flow", action="store_true")
+    parser.add_argument("--output")
+    parser.add_argument("--compose-corpus", action="store_true")
+    sys.exit(0 if main_bench(parser.parse_args()) else 1)
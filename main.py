@@ -1,88 +1,647 @@
 import os
 import sys
+import signal
 import subprocess
 import threading
 import time
 import re
+import json
+import heapq
+import sqlite3
+import struct
+import zlib
+import asyncio
+import concurrent.futures
+import importlib.util
+from fractions import Fraction
+from itertools import product
+from collections import namedtuple, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import cv2
-import pytesseract
-from rich.console import Console
-from rich.table import Table
-from rich import box
-import PySimpleGUI as sg
+import numpy as np
 
 ADB_PATH = "adb\\adb.exe"
+ADB_CLIENT = True
+ADB_HOST = "127.0.0.1"
+ADB_PORT = 5037
+ADB_MAX_CONNECTIONS = 32
+ADB_TIMEOUT = 30
+SCREENCAP_READ_TIMEOUT = 5
 DATA_PATH = "data"
 SCREENSHOT_PATH = "cache\\screenshot.png"
+SAVE_SCREENSHOT = False
+TEMPLATE_SCALE = 0.5
+MATCH_ENGINE = "coarse"
+COARSE_MARGIN = 0.4
+COARSE_CANDIDATES = 4
+COARSE_MIN_SIZE = 12
+REGIONS_PATH = os.path.join(DATA_PATH, "regions.json")
+TEMPLATE_CACHE_PATH = os.path.join("cache", "templates.npz")
+REFERENCE_SIZE = (960, 540)
+TEMPLATE_PYRAMID = (0.5, 0.75)
+SCALE_SEARCH_RANGE = 0.15
+SCALE_SEARCH_STEP = 0.05
+SCALE_ANCHORS = ("home", "map")
+SCALE_ANCHOR_THRESHOLD = 0.9
+SCALE_RETRY_INTERVAL = 2
+SCALE_MAX_MISSES = 20
+SCALE_PHASES = 2
+GLYPHS_PATH = os.path.join(DATA_PATH, "glyphs")
+GLYPH_SIZE = (16, 24)
+GLYPH_MIN_SCORE = 0.8
+TILE_SIZE = 60
+MATCH_CACHE_SIZE = 512
+SCREENS_PATH = os.path.join(DATA_PATH, "screens")
+SCREEN_INDEX_PATH = os.path.join("cache", "screens.npz")
+SCREEN_THUMBNAIL_SIZE = (32, 18)
+SCREEN_MIN_SCORE = 0.95
+SCREEN_MIN_MARGIN = 0.03
+SCREEN_REFERENCES = 8
 TESSERACT_PATH = r"tesseract-ocr\\tesseract.exe"
+MAX_DEVICE_WORKERS = 16
+MAX_ADB_WORKERS = 8
+DEVICE_CACHE_TTL = 3
+DEVICE_HEALTH_INTERVAL = 10
+INPUT_MODE = "input"
+INPUT_MARKER = "__rok_input_done__"
+WAIT_TIMEOUT = 5
+WAIT_SETTLE = 0.3
+WAIT_MIN_INTERVAL = 0.2
+WAIT_MAX_INTERVAL = 1.0
+FLOW_MAX_RECOVERIES = 5
+FLOW_MAX_REPEATS = 10
+FOG_CAMPS = ["1", "2", "3"]
+FOG_MAX_CAMPS = 4
+FOG_IDLE_MIN = 2
+FOG_IDLE_MAX = 60
+MARCH_RETURN_TIME = 3600
+MINE_LEVELS_PATH = os.path.join("cache", "mine_levels.json")
+MINE_LEVEL_STEPS = 6
+MINE_LEVEL_MIN_TRIES = 3
+MINE_LEVEL_MIN_RATE = 0.5
+MINE_LEVEL_WINDOW = 10
+MINE_LEVEL_RECHECK = 3600
+RESOURCE_DB_PATH = os.path.join("cache", "resources.db")
+RESOURCE_TTL = 1800
+MARCH_RETRY_DELAY = 300
+TRACE_PATH = None
+METRICS_PATH = os.path.join("cache", "metrics.prom")
+METRICS_PORT = None
+TRACE_BUFFER_SIZE = 10000
+LOG_PATH = os.path.join("cache", "logs.jsonl")
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+LOG_BUFFER_SIZE = 200
+LOG_REFRESH_MS = 250
+GUI_LOG_LINES = 500
+STATS_REFRESH = 2
+HEADLESS_LOG_PATH = os.path.join("cache", "headless.jsonl")
+HEADLESS_RECONNECT_INTERVAL = 30
 
-console = Console()
-pytesseract.pytesseract.tesseract_cmd = TESSERACT_PATH
+sg = None
 connected_devices = set()
-stop_gather_flag = False
-stop_clear_fog_flag = False
+device_backend = None
 
-def get_ldplayer_devices():
-    result = subprocess.run([ADB_PATH, "devices"], capture_output=True, text=True)
-    lines = result.stdout.strip().splitlines()[1:]
-    devices = []
+Span = namedtuple("Span", ["device", "kind", "step", "start", "duration"])
+
+class Tracer:
+    def __init__(self, path=None, buffer_size=TRACE_BUFFER_SIZE):
+        self.path = path
+        self.file = None
+        self.spans = deque(maxlen=buffer_size)
+        self.totals = {}
+        self.marches = {}
+        self.context = threading.local()
+        self.lock = threading.Lock()
+
+    def bind(self, device_id):
+        self.context.device = device_id
+        self.context.step = None
+
+    def set_step(self, step):
+        self.context.step = step
+        self.context.step_at = time.time()
+
+    def current_step(self):
+        step_at = getattr(self.context, "step_at", None)
+        return getattr(self.context, "step", None), time.time() - step_at if step_at else 0.0
+
+    @contextmanager
+    def span(self, kind):
+        start = time.time()
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(Span(getattr(self.context, "device", None), kind,
+                             getattr(self.context, "step", None), start, time.perf_counter() - begin))
+
+    def record(self, span):
+        with self.lock:
+            self.spans.append(span)
+            key = (span.device, span.kind, span.step)
+            count, total = self.totals.get(key, (0, 0.0))
+            self.totals[key] = (count + 1, total + span.duration)
+            if self.path:
+                if self.file is None:
+                    self.file = open(self.path, "a", encoding="utf-8")
+                self.file.write(json.dumps(span._asdict(), ensure_ascii=False) + "\n")
+
+    def record_march(self, device_id):
+        with self.lock:
+            self.marches[device_id] = self.marches.get(device_id, 0) + 1
+
+    def summary(self, device_id):
+        seconds = {}
+        with self.lock:
+            for (device, kind, _), (_, total) in self.totals.items():
+                if device == device_id:
+                    seconds[kind] = seconds.get(kind, 0.0) + total
+        return seconds
+
+    def prometheus(self):
+        def labels(device, kind=None, step=None):
+            pairs = [("device", device)] + ([("kind", kind), ("step", step)] if kind is not None else [])
+            escaped = ((k, str(v or "").replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+            return ",".join(f'{k}="{v}"' for k, v in escaped)
+
+        with self.lock:
+            totals = sorted(self.totals.items(), key=lambda item: tuple(str(v) for v in item[0]))
+            marches = sorted(self.marches.items())
+        lines = ["# HELP rok_span_seconds_total Time spent per device, span kind and step.",
+                 "# TYPE rok_span_seconds_total counter"]
+        lines += [f"rok_span_seconds_total{{{labels(*key)}}} {total:.6f}" for key, (_, total) in totals]
+        lines += ["# HELP rok_span_count_total Number of spans per device, span kind and step.",
+                  "# TYPE rok_span_count_total counter"]
+        lines += [f"rok_span_count_total{{{labels(*key)}}} {count}" for key, (count, _) in totals]
+        lines += ["# HELP rok_marches_total Marches sent per device.",
+                  "# TYPE rok_marches_total counter"]
+        lines += [f"rok_marches_total{{{labels(device)}}} {count}" for device, count in marches]
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self, path=METRICS_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+
+    def serve_metrics(self, port, host="127.0.0.1"):
+        tracer = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = tracer.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+tracer = Tracer(TRACE_PATH)
+
+class LogPipeline:
+    def __init__(self, path=LOG_PATH, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, buffer_size=LOG_BUFFER_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.buffer_size = buffer_size
+        self.file = None
+        self.buffers = {}
+        self.dropped = {}
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def emit(self, key, device_id, message, started_at=None):
+        step, step_seconds = tracer.current_step()
+        now = time.time()
+        record = {"ts": round(now, 3), "event": key.strip("-").lower(), "device": device_id, "step": step,
+                  "step_seconds": round(step_seconds, 3), "message": message}
+        if started_at is not None:
+            record["elapsed"] = round(now - started_at, 3)
+        with self.lock:
+            buffer = self.buffers.setdefault(device_id, deque(maxlen=self.buffer_size))
+            if len(buffer) == buffer.maxlen:
+                self.dropped[key] = self.dropped.get(key, 0) + 1
+            self.sequence += 1
+            buffer.append((self.sequence, key, f"[{device_id}] {message}"))
+            if self.path:
+                self.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return record
+
+    def write(self, line):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.file = open(self.path, "a", encoding="utf-8")
+        if self.file.tell() + len(line) > self.max_bytes:
+            self.rotate()
+        self.file.write(line)
+        self.file.flush()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def drain(self):
+        with self.lock:
+            entries = sorted(entry for buffer in self.buffers.values() for entry in buffer)
+            for buffer in self.buffers.values():
+                buffer.clear()
+            dropped, self.dropped = self.dropped, {}
+        lines = {}
+        for key, count in dropped.items():
+            lines.setdefault(key, []).append(f"... bỏ qua {count} dòng log")
+        for _, key, line in entries:
+            lines.setdefault(key, []).append(line)
+        return lines
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+log_pipeline = LogPipeline()
+
+class AdbError(Exception):
+    pass
+
+class AdbClient:
+    def __init__(self, host=ADB_HOST, port=ADB_PORT, max_connections=ADB_MAX_CONNECTIONS):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.loop = None
+        self.slots = None
+        self.server_started = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+            return self.loop
+
+    def call(self, coro, timeout=ADB_TIMEOUT):
+        future = asyncio.run_coroutine_threadsafe(coro, self.start())
+        try:
+            return future.result(timeout)
+        except asyncio.IncompleteReadError as e:
+            raise IOError("adb connection closed") from e
+        except concurrent.futures.TimeoutError as e:
+            future.cancel()
+            raise IOError("adb request timed out") from e
+
+    async def _request(self, reader, writer, service):
+        payload = service.encode()
+        writer.write(b"%04x" % len(payload) + payload)
+        await writer.drain()
+        status = await reader.readexactly(4)
+        if status == b"FAIL":
+            raise AdbError(await self._read_message(reader))
+        if status != b"OKAY":
+            raise AdbError(f"unexpected status {status!r}")
+
+    async def _read_message(self, reader):
+        length = int(await reader.readexactly(4), 16)
+        return (await reader.readexactly(length)).decode(errors="ignore")
+
+    async def _open(self, service, serial=None):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            if serial is not None:
+                await self._request(reader, writer, f"host:transport:{serial}")
+            await self._request(reader, writer, service)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _slot(self):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_connections)
+        return self.slots
+
+    async def host_service(self, service):
+        async with await self._slot():
+            reader, writer = await self._open(service)
+            try:
+                return await self._read_message(reader)
+            finally:
+                writer.close()
+
+    async def device_service(self, serial, service):
+        async with await self._slot():
+            reader, writer = await self._open(service, serial)
+            try:
+                return await reader.read()
+            finally:
+                writer.close()
+
+    def ensure_server(self):
+        if self.server_started:
+            return False
+        self.server_started = True
+        subprocess.run([ADB_PATH, "start-server"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return True
+
+    def request(self, coro_func, *args):
+        try:
+            return self.call(coro_func(*args))
+        except ConnectionRefusedError:
+            if not self.ensure_server():
+                raise
+            return self.call(coro_func(*args))
+
+    def command(self, args):
+        serial = None
+        if args[:1] == ["-s"]:
+            serial, args = args[1], args[2:]
+        name, rest = args[0], args[1:]
+        try:
+            if name == "devices" and serial is None:
+                return "List of devices attached\n" + self.request(self.host_service, "host:devices")
+            if name in ("connect", "disconnect") and serial is None and rest:
+                return self.request(self.host_service, f"host:{name}:{rest[0]}") + "\n"
+            if name == "get-state" and serial is not None:
+                return self.request(self.host_service, f"host-serial:{serial}:get-state") + "\n"
+            if name in ("shell", "exec-out") and serial is not None:
+                service = ("shell:" if name == "shell" else "exec:") + " ".join(rest)
+                return self.request(self.device_service, serial, service).decode(errors="ignore")
+        except AdbError:
+            return ""
+        raise AdbError(f"unsupported command: {' '.join(args)}")
+
+    def exec_out(self, serial, command):
+        return self.request(self.device_service, serial, f"exec:{command}")
+
+    def open_shell(self, serial):
+        reader, writer = self.request(self._open, "shell,v2,raw:", serial)
+        return AdbShell(self, reader, writer)
+
+    def close(self):
+        with self.lock:
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.loop = None
+                self.slots = None
+
+class AdbShell:
+    def __init__(self, client, reader, writer):
+        self.client = client
+        self.reader = reader
+        self.writer = writer
+        self.buffer = bytearray()
+        self.returncode = None
+        self.stdin = self
+        self.stdout = self
+
+    async def _send(self, packet_id, data):
+        self.writer.write(struct.pack("<BI", packet_id, len(data)) + data)
+        await self.writer.drain()
+
+    async def _fill(self, ready):
+        while not ready() and self.returncode is None:
+            try:
+                packet_id, length = struct.unpack("<BI", await self.reader.readexactly(5))
+                data = await self.reader.readexactly(length)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.returncode = -1
+                break
+            if packet_id == 1:
+                self.buffer.extend(data)
+            elif packet_id == 3:
+                self.returncode = data[0] if data else 0
+
+    def write(self, data):
+        if self.returncode is not None:
+            raise IOError("adb shell closed")
+        self.client.call(self._send(0, bytes(data)))
+
+    def flush(self):
+        pass
+
+    def read(self, size):
+        self.client.call(self._fill(lambda: len(self.buffer) >= size))
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self):
+        self.client.call(self._fill(lambda: b"\n" in self.buffer))
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+        data = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return data
+
+    def poll(self):
+        return self.returncode
+
+    def close(self):
+        if self.returncode is None:
+            self.client.call(self._send(4, b""))
+
+    def kill(self):
+        if self.returncode is None:
+            self.returncode = -9
+        if loop := self.client.loop:
+            loop.call_soon_threadsafe(self.writer.close)
+
+    def wait(self):
+        return self.returncode
+
+adb_client = AdbClient()
+
+def adb_command(*args):
+    if device_backend is not None:
+        return device_backend.command(list(args))
+    if ADB_CLIENT:
+        try:
+            return adb_client.command(list(args))
+        except (AdbError, OSError):
+            pass
+    result = subprocess.run([ADB_PATH, *args], capture_output=True, text=True)
+    return result.stdout
+
+def adb_exec_out(device_id, command):
+    if ADB_CLIENT:
+        try:
+            return adb_client.exec_out(device_id, command)
+        except (AdbError, OSError):
+            pass
+    result = subprocess.run([ADB_PATH, "-s", device_id, "exec-out", command],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return result.stdout
+
+def adb_shell_process(device_id):
+    if ADB_CLIENT:
+        try:
+            return adb_client.open_shell(device_id)
+        except (AdbError, OSError):
+            pass
+    return subprocess.Popen([ADB_PATH, "-s", device_id, "shell"],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+
+def get_device_states():
+    output = adb_command("devices")
+    lines = output.strip().splitlines()[1:]
+    states = {}
     for line in lines:
         if not line.strip():
             continue
         parts = line.split()
-        device_id = parts[0]
-        if device_id.startswith("emulator-"):
-            devices.append(device_id)
-    return devices
+        states[parts[0]] = parts[1] if len(parts) > 1 else "unknown"
+    return states
+
+def get_ldplayer_devices():
+    return [device_id for device_id in get_device_states() if device_id.startswith("emulator-")]
+
+class DeviceManager:
+    def __init__(self, max_workers=MAX_ADB_WORKERS, ttl=DEVICE_CACHE_TTL):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.ttl = ttl
+        self.states = {}
+        self.refreshed_at = 0
+        self.listeners = []
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        states = get_device_states()
+        with self.lock:
+            self.states = states
+            self.refreshed_at = time.time()
+        return states
 
-def list_devices():
-    devices = get_ldplayer_devices()
+    def invalidate(self):
+        self.refreshed_at = 0
+
+    def devices(self, max_age=None):
+        states = self.states
+        if time.time() - self.refreshed_at > (self.ttl if max_age is None else max_age):
+            states = self.refresh()
+        return [device_id for device_id in states if device_id.startswith("emulator-")]
+
+    def online(self):
+        with self.lock:
+            return set(connected_devices)
+
+    def mark(self, device_id, online):
+        with self.lock:
+            changed = (device_id in connected_devices) != online
+            if online:
+                connected_devices.add(device_id)
+            else:
+                connected_devices.discard(device_id)
+        if changed:
+            self.notify(device_id, "online" if online else "offline")
+
+    def run_all(self, func, targets):
+        return list(self.pool.map(func, targets))
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    def notify(self, device_id, status):
+        for callback in self.listeners:
+            callback(device_id, status)
+
+    def probe(self, device_id):
+        return adb_command("-s", device_id, "get-state").strip() == "device"
+
+    def check_health(self):
+        states = self.refresh()
+        online = sorted(self.online())
+        alive = self.run_all(lambda device_id: states.get(device_id) == "device" and self.probe(device_id), online)
+        dropped = [device_id for device_id, ok in zip(online, alive) if not ok]
+        for device_id in dropped:
+            self.mark(device_id, False)
+        return dropped
+
+    def start_monitor(self, interval=DEVICE_HEALTH_INTERVAL):
+        def monitor():
+            while not self.stop_event.wait(interval):
+                try:
+                    self.check_health()
+                except (OSError, subprocess.SubprocessError):
+                    pass
+        threading.Thread(target=monitor, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.pool.shutdown(wait=False)
+
+device_manager = DeviceManager()
+
+def list_devices(max_age=None):
+    devices = device_manager.devices(max_age)
+    online = device_manager.online()
     data = []
     for dev in devices:
-        status = "online" if dev in connected_devices else "offline"
+        status = "online" if dev in online else "offline"
         data.append((dev, status))
     return data
 
-def connect_devices(selection, devices):
+def select_targets(selection, devices, online_only=False):
+    candidates = [d for d in devices if d[1] == "online"] if online_only else devices
     targets = []
     if selection.lower() == "all":
-        targets = [d[0] for d in devices]
+        targets = [d[0] for d in candidates]
     else:
         for idx in selection.split(","):
             idx = idx.strip()
             if idx.isdigit() and 1 <= int(idx) <= len(devices):
-                targets.append(devices[int(idx)-1][0])
+                dev_id, status = devices[int(idx)-1]
+                if not online_only or status == "online":
+                    targets.append(dev_id)
+    return targets
 
-    results = []
-    for dev in targets:
+def connect_devices(selection, devices):
+    def connect(dev):
         port_num = int(dev.split("-")[-1]) + 1
         ip_port = f"127.0.0.1:{port_num}"
-        result = subprocess.run([ADB_PATH, "connect", ip_port], capture_output=True, text=True)
-        if "connected" in result.stdout.lower() or "already" in result.stdout.lower():
-            connected_devices.add(dev)
-            results.append((dev, True, "Connected"))
-        else:
-            results.append((dev, False, result.stdout.strip()))
+        output = adb_command("connect", ip_port)
+        if "connected" in output.lower() or "already" in output.lower():
+            device_manager.mark(dev, True)
+            return (dev, True, "Connected")
+        return (dev, False, output.strip())
+
+    results = device_manager.run_all(connect, select_targets(selection, devices))
+    device_manager.invalidate()
     return results
 
 def disconnect_devices(selection, devices):
-    targets = []
-    if selection.lower() == "all":
-        targets = [d[0] for d in devices]
-    else:
-        for idx in selection.split(","):
-            idx = idx.strip()
-            if idx.isdigit() and 1 <= int(idx) <= len(devices):
-                targets.append(devices[int(idx)-1][0])
-
-    results = []
-    for dev in targets:
+    def disconnect(dev):
         port_num = int(dev.split("-")[-1]) + 1
         ip_port = f"127.0.0.1:{port_num}"
-        subprocess.run([ADB_PATH, "disconnect", ip_port],
-                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        connected_devices.discard(dev)
-        results.append((dev, True, "Disconnected"))
+        adb_command("disconnect", ip_port)
+        device_manager.mark(dev, False)
+        return (dev, True, "Disconnected")
+
+    results = device_manager.run_all(disconnect, select_targets(selection, devices))
+    device_manager.invalidate()
     return results
 
 def launch_game(selection, devices, package_name):
@@ -90,21 +649,9 @@ def launch_game(selection, devices, package_name):
     if not online_devices:
         return "No online devices available to launch game"
 
-    targets = []
-    if selection.lower() == "all":
-        targets = [d[0] for d in online_devices]
-    else:
-        for idx in selection.split(","):
-            idx = idx.strip()
-            if idx.isdigit() and 1 <= int(idx) <= len(devices):
-                dev_id, status = devices[int(idx)-1]
-                if status == "online":
-                    targets.append(dev_id)
-
-    for dev in targets:
-        subprocess.run([ADB_PATH, "-s", dev, "shell", "monkey",
-                       "-p", package_name, "-c", "android.intent.category.LAUNCHER", "1"],
-                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    targets = select_targets(selection, devices, online_only=True)
+    device_manager.run_all(lambda dev: adb_command("-s", dev, "shell", "monkey", "-p", package_name,
+                                                   "-c", "android.intent.category.LAUNCHER", "1"), targets)
     return f"Launched {package_name} on {len(targets)} devices"
 
 def close_game(selection, devices, package_name):
@@ -112,47 +659,736 @@ def close_game(selection, devices, package_name):
     if not online_devices:
         return "No online devices available to close game"
 
-    targets = []
-    if selection.lower() == "all":
-        targets = [d[0] for d in online_devices]
-    else:
-        for idx in selection.split(","):
-            idx = idx.strip()
-            if idx.isdigit() and 1 <= int(idx) <= len(devices):
-                dev_id, status = devices[int(idx)-1]
-                if status == "online":
-                    targets.append(dev_id)
-
-    for dev in targets:
-        subprocess.run([ADB_PATH, "-s", dev, "shell", "am", "force-stop", package_name],
-                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    targets = select_targets(selection, devices, online_only=True)
+    device_manager.run_all(lambda dev: adb_command("-s", dev, "shell", "am", "force-stop", package_name), targets)
     return f"Closed {package_name} on {len(targets)} devices"
 
-def adb_screencap(device_id, output=SCREENSHOT_PATH):
-    subprocess.run([ADB_PATH, "-s", device_id, "shell", "screencap", "-p", "/sdcard/screen.png"],
-                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    subprocess.run([ADB_PATH, "-s", device_id, "pull", "/sdcard/screen.png", output],
-                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-def adb_tap(device_id, x, y):
-    subprocess.run([ADB_PATH, "-s", device_id, "shell", "input", "tap", str(x), str(y)],
-                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+SCREENCAP_FORMATS = {1: (4, cv2.COLOR_RGBA2BGR), 2: (4, cv2.COLOR_RGBA2BGR),
+                     3: (3, cv2.COLOR_RGB2BGR), 5: (4, cv2.COLOR_BGRA2BGR)}
 
-def find_image(target_path, screenshot_path=SCREENSHOT_PATH, threshold=0.85):
-    if not os.path.exists(target_path):
+def decode_raw_screencap(data, header_size):
+    if len(data) < 12:
         return None
-    img_rgb = cv2.imread(screenshot_path)
-    template = cv2.imread(target_path)
-    if img_rgb is None or template is None:
+    width, height, fmt = struct.unpack_from("<III", data, 0)
+    if fmt not in SCREENCAP_FORMATS:
+        return None
+    bpp, conversion = SCREENCAP_FORMATS[fmt]
+    size = width * height * bpp
+    with tracer.span("decode"):
+        pixels = np.frombuffer(data, dtype=np.uint8, count=size, offset=header_size)
+        return cv2.cvtColor(pixels.reshape(height, width, bpp), conversion)
+
+def adb_screencap_raw(device_id):
+    data = adb_exec_out(device_id, "screencap")
+    if len(data) < 12:
+        return None, None
+    width, height, fmt = struct.unpack_from("<III", data, 0)
+    if fmt not in SCREENCAP_FORMATS:
+        return None, None
+    header_size = len(data) - width * height * SCREENCAP_FORMATS[fmt][0]
+    if header_size not in (12, 16):
+        return None, None
+    return decode_raw_screencap(data, header_size), header_size
+
+class ScreencapStream:
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.proc = None
+        self.header_size = None
+        self.reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="screencap")
+        self.lock = threading.Lock()
+
+    def _open(self):
+        self.close()
+        self.proc = adb_shell_process(self.device_id)
+
+    def _read_exact(self, size):
+        future = self.reader.submit(self.proc.stdout.read, size)
+        try:
+            data = future.result(SCREENCAP_READ_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            self.close()
+            raise IOError("screencap stream timed out")
+        if data is None or len(data) != size:
+            raise IOError("screencap stream closed")
+        return data
+
+    def _grab_stream(self):
+        if self.proc is None or self.proc.poll() is not None:
+            self._open()
+        self.proc.stdin.write(b"screencap\n")
+        self.proc.stdin.flush()
+        header = self._read_exact(self.header_size)
+        width, height, fmt = struct.unpack_from("<III", header, 0)
+        if fmt not in SCREENCAP_FORMATS:
+            raise IOError(f"unsupported screencap format {fmt}")
+        body = self._read_exact(width * height * SCREENCAP_FORMATS[fmt][0])
+        return decode_raw_screencap(header + body, self.header_size)
+
+    def grab(self):
+        with self.lock:
+            if self.header_size is None:
+                img, self.header_size = adb_screencap_raw(self.device_id)
+                return img
+            try:
+                return self._grab_stream()
+            except (IOError, OSError, ValueError):
+                self.close()
+                img, header_size = adb_screencap_raw(self.device_id)
+                if header_size:
+                    self.header_size = header_size
+                return img
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+screencap_streams = {}
+screencap_streams_lock = threading.Lock()
+
+def get_screencap_stream(device_id):
+    with screencap_streams_lock:
+        if device_id not in screencap_streams:
+            screencap_streams[device_id] = ScreencapStream(device_id)
+        return screencap_streams[device_id]
+
+def close_screencap_streams():
+    with screencap_streams_lock:
+        for stream in screencap_streams.values():
+            stream.close()
+            stream.reader.shutdown(wait=False)
+        screencap_streams.clear()
+
+def adb_screencap(device_id):
+    with tracer.span("screencap"):
+        if device_backend is not None:
+            return device_backend.screencap(device_id)
+        return get_screencap_stream(device_id).grab()
+
+class Frame:
+    def __init__(self, image, device_id=None):
+        self.image = image
+        self.device_id = device_id
+        self.timestamp = time.time()
+        self._gray = None
+        self._small = None
+        self._tiles = None
+        self._thumbnail = None
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    @property
+    def small(self):
+        if self._small is None:
+            self._small = cv2.resize(self.gray, None, fx=TEMPLATE_SCALE, fy=TEMPLATE_SCALE,
+                                     interpolation=cv2.INTER_AREA)
+        return self._small
+
+    @property
+    def height(self):
+        return self.image.shape[0]
+
+    @property
+    def width(self):
+        return self.image.shape[1]
+
+    @property
+    def tiles(self):
+        if self._tiles is None:
+            self._tiles = [[zlib.crc32(self.image[y:y + TILE_SIZE, x:x + TILE_SIZE].tobytes())
+                            for x in range(0, self.width, TILE_SIZE)]
+                           for y in range(0, self.height, TILE_SIZE)]
+        return self._tiles
+
+    @property
+    def thumbnail(self):
+        if self._thumbnail is None:
+            small = cv2.resize(self.gray, SCREEN_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32).ravel()
+            small -= small.mean()
+            norm = np.linalg.norm(small)
+            self._thumbnail = small / norm if norm else small
+        return self._thumbnail
+
+    def region_key(self, box):
+        x1, y1, x2, y2 = box
+        tiles = self.tiles
+        rows = range(y1 // TILE_SIZE, (y2 - 1) // TILE_SIZE + 1)
+        cols = range(x1 // TILE_SIZE, (x2 - 1) // TILE_SIZE + 1)
+        return (self.width, self.height, box, hash(tuple(tiles[r][c] for r in rows for c in cols)))
+
+    def save(self, path=SCREENSHOT_PATH):
+        cv2.imwrite(path, self.image)
+
+def capture_frame(device_id):
+    img = adb_screencap(device_id)
+    if img is None:
         return None
-    res = cv2.matchTemplate(img_rgb, template, cv2.TM_CCOEFF_NORMED)
+    frame = Frame(img, device_id)
+    if SAVE_SCREENSHOT:
+        frame.save()
+    return frame
+
+class InputSession:
+    def __init__(self, device_id, mode=INPUT_MODE):
+        self.device_id = device_id
+        self.mode = mode
+        self.proc = None
+        self.touch = None
+        self.lock = threading.Lock()
+
+    def _open(self):
+        self.close()
+        self.proc = adb_shell_process(self.device_id)
+
+    def _run(self, commands):
+        if self.proc is None or self.proc.poll() is not None:
+            self._open()
+        script = "; ".join(commands + [f"echo {INPUT_MARKER}"]) + "\n"
+        self.proc.stdin.write(script.encode())
+        self.proc.stdin.flush()
+        output = []
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                raise IOError("input session closed")
+            line = line.decode(errors="ignore").rstrip()
+            if line == INPUT_MARKER:
+                return output
+            output.append(line)
+
+    def run(self, commands):
+        with self.lock:
+            try:
+                return self._run(commands)
+            except (IOError, OSError):
+                self.close()
+                return self._run(commands)
+
+    def _find_touch_device(self):
+        device, max_x, max_y = None, None, None
+        for line in self.run(["getevent -pl"]):
+            if line.startswith("add device"):
+                if max_x and max_y:
+                    break
+                device, max_x, max_y = line.split(":", 1)[1].strip(), None, None
+            elif "ABS_MT_POSITION_X" in line and (m := re.search(r"max (\d+)", line)):
+                max_x = int(m.group(1))
+            elif "ABS_MT_POSITION_Y" in line and (m := re.search(r"max (\d+)", line)):
+                max_y = int(m.group(1))
+        sizes = re.findall(r"(\d+)x(\d+)", " ".join(self.run(["wm size"])))
+        if not (device and max_x and max_y and sizes):
+            return None
+        width, height = map(int, sizes[-1])
+        return device, max_x / max(1, width - 1), max_y / max(1, height - 1)
+
+    def tap_commands(self, x, y):
+        if self.mode == "sendevent":
+            if self.touch is None:
+                self.touch = self._find_touch_device() or False
+            if self.touch:
+                device, sx, sy = self.touch
+                events = [(3, 57, 0), (3, 53, int(x * sx)), (3, 54, int(y * sy)), (1, 330, 1), (0, 0, 0),
+                          (3, 57, 4294967295), (1, 330, 0), (0, 0, 0)]
+                return [f"sendevent {device} {t} {c} {v}" for t, c, v in events]
+        return [f"input tap {int(x)} {int(y)}"]
+
+    def tap_batch(self, points, interval=0):
+        commands = []
+        for i, (x, y) in enumerate(points):
+            if i and interval:
+                commands.append(f"sleep {interval}")
+            commands.extend(self.tap_commands(x, y))
+        self.run(commands)
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+input_sessions = {}
+input_sessions_lock = threading.Lock()
+
+def get_input_session(device_id):
+    with input_sessions_lock:
+        if device_id not in input_sessions:
+            input_sessions[device_id] = InputSession(device_id)
+        return input_sessions[device_id]
+
+def close_input_sessions():
+    with input_sessions_lock:
+        for session in input_sessions.values():
+            session.close()
+        input_sessions.clear()
+
+def adb_tap(device_id, x, y):
+    adb_tap_batch(device_id, [(x, y)])
+
+def adb_tap_batch(device_id, points, interval=0):
+    with tracer.span("tap"):
+        if device_backend is not None:
+            return device_backend.tap_batch(device_id, points, interval)
+        try:
+            get_input_session(device_id).tap_batch(points, interval)
+        except (IOError, OSError):
+            for x, y in points:
+                adb_command("-s", device_id, "shell", "input", "tap", str(x), str(y))
+                time.sleep(interval)
+
+class Template:
+    def __init__(self, name, image):
+        self.name = name
+        self.mask = None
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        elif image.shape[2] == 4:
+            alpha = image[:, :, 3]
+            if (alpha < 255).any():
+                self.mask = alpha.copy()
+            image = image[:, :, :3]
+        self.color = np.ascontiguousarray(image)
+        self.gray = cv2.cvtColor(self.color, cv2.COLOR_BGR2GRAY)
+        self.small = cv2.resize(self.gray, None, fx=TEMPLATE_SCALE, fy=TEMPLATE_SCALE,
+                                interpolation=cv2.INTER_AREA)
+        self.height, self.width = self.color.shape[:2]
+        self.coarse = min(self.small.shape) >= COARSE_MIN_SIZE and float(self.small.std()) > 1
+        self.region = None
+        self.fallback = True
+        self.scale = 1.0
+        self.pyramid = {}
+        self.phases = [self.color]
+
+    def at(self, scale):
+        scale = round(scale, 4)
+        if scale == self.scale:
+            return self
+        if (variant := self.pyramid.get(scale)) is None:
+            phases = [self.resize(self.color, scale, dx, dy) for dx, dy in product(range(self.period(scale)), repeat=2)]
+            image = phases[0]
+            if self.mask is not None:
+                image = np.dstack([image, self.resize(self.mask, scale)])
+            variant = Template(self.name, image)
+            variant.region, variant.fallback, variant.scale = self.region, self.fallback, scale
+            variant.phases = phases
+            self.pyramid[scale] = variant
+        return variant
+
+    @staticmethod
+    def period(scale):
+        return min(SCALE_PHASES, Fraction(scale).limit_denominator(4).denominator)
+
+    def resize(self, image, scale, dx=0, dy=0):
+        pad = self.period(scale)
+        canvas = cv2.copyMakeBorder(image, dy, pad - dy, dx, pad - dx, cv2.BORDER_REPLICATE)
+        resized = cv2.resize(canvas, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        x, y = int(np.ceil(dx * scale)), int(np.ceil(dy * scale))
+        width, height = max(1, int(self.width * scale)), max(1, int(self.height * scale))
+        return np.ascontiguousarray(resized[y:y + height, x:x + width])
+
+    def scaled_region(self, frame):
+        if self.region is None:
+            return None
+        sx = frame.width / REFERENCE_SIZE[0]
+        sy = frame.height / REFERENCE_SIZE[1]
+        x, y, w, h = self.region
+        x1, y1 = max(0, int(x * sx)), max(0, int(y * sy))
+        x2, y2 = min(frame.width, int((x + w) * sx)), min(frame.height, int((y + h) * sy))
+        if x2 - x1 < self.width or y2 - y1 < self.height:
+            return None
+        return (x1, y1, x2, y2)
+
+class TemplateLibrary:
+    def __init__(self, path=DATA_PATH):
+        self.path = path
+        self.templates = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            files = []
+            for file in sorted(os.listdir(self.path)):
+                path = os.path.join(self.path, file)
+                if file.endswith(".png") and os.path.isfile(path):
+                    stat = os.stat(path)
+                    files.append((os.path.splitext(file)[0], path, stat.st_mtime_ns, stat.st_size))
+            signature = json.dumps([(name, mtime, size) for name, _, mtime, size in files])
+            if (images := self.load_cache(signature)) is None:
+                images = {}
+                for name, path, _, _ in files:
+                    if (image := cv2.imread(path, cv2.IMREAD_UNCHANGED)) is not None:
+                        images[name] = image
+                self.save_cache(signature, images)
+            for name, image in images.items():
+                self.templates[name] = Template(name, image)
+            self.load_regions()
+            for template in self.templates.values():
+                for scale in TEMPLATE_PYRAMID:
+                    template.at(scale)
+            self.loaded = True
+
+    def load_cache(self, signature, path=TEMPLATE_CACHE_PATH):
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if str(data["__signature__"]) != signature:
+                    return None
+                return {name: data[name] for name in data.files if name != "__signature__"}
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save_cache(self, signature, images, path=TEMPLATE_CACHE_PATH):
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            np.savez(path, __signature__=np.array(signature), **images)
+        except OSError:
+            pass
+
+    def load_regions(self, path=REGIONS_PATH):
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        for name, entry in manifest.items():
+            if name in self.templates:
+                self.templates[name].region = tuple(entry["region"])
+                self.templates[name].fallback = entry.get("fallback", True)
+                self.templates[name].pyramid.clear()
+
+    def get(self, name):
+        if not self.loaded:
+            self.load()
+        return self.templates.get(name)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+templates = TemplateLibrary(DATA_PATH)
+
+def match_map(template, image):
+    res = cv2.matchTemplate(image, template.phases[0], cv2.TM_CCOEFF_NORMED)
+    for phase in template.phases[1:]:
+        np.maximum(res, cv2.matchTemplate(image, phase, cv2.TM_CCOEFF_NORMED), out=res)
+    return res
+
+def match_template(template, image, offset=(0, 0)):
+    res = match_map(template, image)
     _, max_val, _, max_loc = cv2.minMaxLoc(res)
-    if max_val >= threshold:
-        center_x = int(max_loc[0] + template.shape[1] / 2)
-        center_y = int(max_loc[1] + template.shape[0] / 2)
-        return (center_x, center_y)
+    return max_val, (max_loc[0] + offset[0], max_loc[1] + offset[1])
+
+Match = namedtuple("Match", ["name", "score", "center", "box"])
+
+def score_peaks(template, image, threshold, max_hits=1, offset=(0, 0)):
+    if max_hits == 1:
+        max_val, max_loc = match_template(template, image, offset)
+        return [(max_val, max_loc)] if max_val >= threshold else []
+    res = match_map(template, image)
+    kernel = np.ones((max(1, template.height // 2), max(1, template.width // 2)), np.uint8)
+    peaks = (res >= threshold) & (res == cv2.dilate(res, kernel))
+    ys, xs = np.nonzero(peaks)
+    hits = [(float(res[y, x]), (int(x) + offset[0], int(y) + offset[1])) for y, x in zip(ys, xs)]
+    hits.sort(key=lambda hit: hit[0], reverse=True)
+    return hits
+
+def coarse_peaks(template, frame, box, threshold, max_hits=1):
+    x1, y1, x2, y2 = box
+    sx1, sy1 = int(x1 * TEMPLATE_SCALE), int(y1 * TEMPLATE_SCALE)
+    sx2, sy2 = int(x2 * TEMPLATE_SCALE), int(y2 * TEMPLATE_SCALE)
+    small = frame.small[sy1:sy2, sx1:sx2]
+    th, tw = template.small.shape
+    if not template.coarse or small.shape[0] < th or small.shape[1] < tw:
+        return score_peaks(template, frame.image[y1:y2, x1:x2], threshold, max_hits, (x1, y1))
+    res = cv2.matchTemplate(small, template.small, cv2.TM_CCOEFF_NORMED)
+    kernel = np.ones((max(1, th // 2), max(1, tw // 2)), np.uint8)
+    peaks = (res >= threshold - COARSE_MARGIN) & (res == cv2.dilate(res, kernel))
+    ys, xs = np.nonzero(peaks)
+    order = np.argsort(res[ys, xs])[::-1][:COARSE_CANDIDATES * max_hits]
+    pad = int(np.ceil(1 / TEMPLATE_SCALE)) + 1
+    hits = {}
+    for y, x in zip(ys[order], xs[order]):
+        wx1 = max(x1, int((x + sx1) / TEMPLATE_SCALE) - pad)
+        wy1 = max(y1, int((y + sy1) / TEMPLATE_SCALE) - pad)
+        wx2 = min(x2, wx1 + template.width + 2 * pad)
+        wy2 = min(y2, wy1 + template.height + 2 * pad)
+        if wx2 - wx1 < template.width or wy2 - wy1 < template.height:
+            continue
+        score, loc = match_template(template, frame.image[wy1:wy2, wx1:wx2], (wx1, wy1))
+        if score >= threshold and score > hits.get(loc, -1.0):
+            hits[loc] = score
+    return sorted(((score, loc) for loc, score in hits.items()), key=lambda hit: hit[0], reverse=True)
+
+class MatchCache:
+    def __init__(self, size=MATCH_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+match_cache = MatchCache()
+
+def cached_peaks(template, frame, box, threshold, max_hits):
+    key = (template.name, template.scale, MATCH_ENGINE, threshold, max_hits, frame.region_key(box))
+    hits = match_cache.get(key)
+    if hits is None:
+        x1, y1, x2, y2 = box
+        with tracer.span("match"):
+            if MATCH_ENGINE == "coarse":
+                hits = coarse_peaks(template, frame, box, threshold, max_hits)
+            else:
+                hits = score_peaks(template, frame.image[y1:y2, x1:x2], threshold, max_hits, (x1, y1))
+        match_cache.put(key, hits)
+    return hits
+
+def locate_template(template, frame, threshold, max_hits=1):
+    if region := template.scaled_region(frame):
+        hits = cached_peaks(template, frame, region, threshold, max_hits)
+        if hits or not template.fallback:
+            return hits
+    return cached_peaks(template, frame, (0, 0, frame.width, frame.height), threshold, max_hits)
+
+device_scales = {}
+device_scales_lock = threading.Lock()
+
+def search_scale(template, image, scales):
+    best = (None, -1.0)
+    for scale in scales:
+        variant = template.at(scale)
+        if variant.height > image.shape[0] or variant.width > image.shape[1]:
+            continue
+        score, _ = match_template(variant, image)
+        if score > best[1]:
+            best = (scale, score)
+    return best
+
+def calibrate_scale(template, frame, nominal):
+    x1, y1, x2, y2 = template.at(nominal).scaled_region(frame) or (0, 0, frame.width, frame.height)
+    image = frame.image[y1:y2, x1:x2]
+    scale, score = search_scale(template, image, [nominal])
+    if score >= SCALE_ANCHOR_THRESHOLD:
+        return scale, score
+    steps = round(SCALE_SEARCH_RANGE / SCALE_SEARCH_STEP)
+    coarse = [nominal * (1 + i * SCALE_SEARCH_STEP) for i in range(-steps, steps + 1)]
+    half = cv2.resize(image, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+    scale, _ = search_scale(template, half, [s / 2 for s in coarse])
+    if scale is None:
+        return nominal, -1.0
+    fine = [round(scale * 2 + i * 0.01, 2) for i in range(-2, 3)]
+    return search_scale(template, image, fine)
+
+def resolve_template(template, frame, threshold):
+    nominal = frame.width / REFERENCE_SIZE[0]
+    if abs(nominal - 1) < 0.01:
+        return template
+    key = (frame.device_id, frame.width, frame.height)
+    with device_scales_lock:
+        state = device_scales.setdefault(key, {"scale": None, "misses": 0, "retry_at": 0.0})
+        calibrate = (template.name in SCALE_ANCHORS and time.time() >= state["retry_at"]
+                     and (state["scale"] is None or state["misses"] >= SCALE_MAX_MISSES))
+        if calibrate:
+            state["retry_at"] = time.time() + SCALE_RETRY_INTERVAL
+    if calibrate:
+        scale, score = calibrate_scale(template, frame, nominal)
+        if score >= SCALE_ANCHOR_THRESHOLD:
+            with device_scales_lock:
+                state.update(scale=scale, misses=0, retry_at=0.0)
+    return template.at(state["scale"] or nominal)
+
+def track_scale(template, frame, found):
+    if template.name not in SCALE_ANCHORS:
+        return
+    with device_scales_lock:
+        if (state := device_scales.get((frame.device_id, frame.width, frame.height))) is not None:
+            state["misses"] = 0 if found else state["misses"] + 1
+
+def make_match(template, score, loc):
+    x, y = loc
+    center = (int(x + template.width / 2), int(y + template.height / 2))
+    return Match(template.name, score, center, (x, y, template.width, template.height))
+
+def box_overlap(a, b):
+    ix = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union else 0
+
+def non_max_suppression(matches, overlap=0.3):
+    kept = []
+    for match in sorted(matches, key=lambda m: m.score, reverse=True):
+        if all(box_overlap(match.box, other.box) <= overlap for other in kept):
+            kept.append(match)
+    return kept
+
+def detect_all(frame, names, threshold=0.85, max_hits=1, overlap=0.3):
+    if frame is None:
+        return []
+    matches = []
+    for name in names:
+        template = templates.get(name)
+        if template is None:
+            continue
+        template = resolve_template(template, frame, threshold)
+        hits = locate_template(template, frame, threshold, max_hits)
+        track_scale(template, frame, hits)
+        found = non_max_suppression([make_match(template, score, loc) for score, loc in hits], overlap)
+        matches.extend(found[:max_hits])
+    return non_max_suppression(matches, overlap)
+
+def detect_any(frame, names, threshold=0.85):
+    matches = detect_all(frame, names, threshold)
+    return matches[0] if matches else None
+
+def find_image(name, frame, threshold=0.85):
+    template = templates.get(name)
+    if frame is None or template is None:
+        return None
+    template = resolve_template(template, frame, threshold)
+    hits = locate_template(template, frame, threshold)
+    track_scale(template, frame, hits)
+    if hits:
+        return make_match(template, *hits[0]).center
     return None
 
+class ScreenIndex:
+    def __init__(self, path, cache_path):
+        self.path = path
+        self.cache_path = cache_path
+        self.names = []
+        self.vectors = np.zeros((0, SCREEN_THUMBNAIL_SIZE[0] * SCREEN_THUMBNAIL_SIZE[1]), np.float32)
+        self.lock = threading.Lock()
+
+    def load(self):
+        if os.path.exists(self.cache_path):
+            try:
+                with np.load(self.cache_path) as data:
+                    names, vectors = data["names"], data["vectors"]
+            except (OSError, ValueError, KeyError):
+                names, vectors = [], self.vectors
+            if vectors.shape[1:] == self.vectors.shape[1:]:
+                for name, vector in zip(names, vectors):
+                    self.add_vector(str(name), vector)
+        if os.path.isdir(self.path):
+            for file in sorted(os.listdir(self.path)):
+                if file.endswith(".png") and (image := cv2.imread(os.path.join(self.path, file))) is not None:
+                    self.add(re.sub(r"_\d+$", "", file[:-4]), Frame(image))
+
+    def save(self):
+        with self.lock:
+            if not self.names:
+                return
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            np.savez_compressed(self.cache_path, names=np.array(self.names), vectors=self.vectors)
+
+    def count(self, name):
+        return self.names.count(name)
+
+    def add(self, name, frame):
+        if frame is not None:
+            self.add_vector(name, frame.thumbnail)
+
+    def add_vector(self, name, vector):
+        with self.lock:
+            rows = [i for i, other in enumerate(self.names) if other == name]
+            if rows and float(np.max(self.vectors[rows] @ vector)) >= 0.99:
+                return
+            names, vectors = self.names, self.vectors
+            if len(rows) >= SCREEN_REFERENCES:
+                keep = [i for i in range(len(names)) if i != rows[0]]
+                names, vectors = [names[i] for i in keep], vectors[keep]
+            self.vectors = np.vstack([vectors, vector[None, :]])
+            self.names = names + [name]
+
+    def scores(self, frame):
+        names, vectors = self.names, self.vectors
+        best = {}
+        for name, score in zip(names, vectors @ frame.thumbnail):
+            best[name] = max(best.get(name, -1.0), float(score))
+        return sorted(best.items(), key=lambda item: item[1], reverse=True)
+
+    def predict(self, frame):
+        if frame is None or not self.names:
+            return None
+        ranked = self.scores(frame)
+        name, score = ranked[0]
+        margin = score - ranked[1][1] if len(ranked) > 1 else score
+        return name if score >= SCREEN_MIN_SCORE and margin >= SCREEN_MIN_MARGIN else None
+
+screen_index = ScreenIndex(SCREENS_PATH, SCREEN_INDEX_PATH)
+
+def learn_regions(corpus_path, threshold=0.85, padding=24, output=REGIONS_PATH):
+    templates.load()
+    boxes = {}
+    for file in sorted(os.listdir(corpus_path)):
+        if not file.endswith(".png"):
+            continue
+        image = cv2.imread(os.path.join(corpus_path, file))
+        if image is None:
+            continue
+        frame = Frame(image)
+        sx = REFERENCE_SIZE[0] / frame.width
+        sy = REFERENCE_SIZE[1] / frame.height
+        for name, template in templates.templates.items():
+            max_val, (x, y) = match_template(template, frame.image)
+            if max_val < threshold:
+                continue
+            box = (x * sx, y * sy, (x + template.width) * sx, (y + template.height) * sy)
+            if name in boxes:
+                old = boxes[name]
+                box = (min(old[0], box[0]), min(old[1], box[1]), max(old[2], box[2]), max(old[3], box[3]))
+            boxes[name] = box
+
+    manifest = {}
+    if os.path.exists(output):
+        with open(output, encoding="utf-8") as f:
+            manifest = json.load(f)
+    for name, (x1, y1, x2, y2) in boxes.items():
+        x1, y1 = max(0, int(x1) - padding), max(0, int(y1) - padding)
+        x2 = min(REFERENCE_SIZE[0], int(x2) + padding)
+        y2 = min(REFERENCE_SIZE[1], int(y2) + padding)
+        entry = manifest.get(name, {})
+        entry["region"] = [x1, y1, x2 - x1, y2 - y1]
+        manifest[name] = entry
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+    for name in boxes:
+        if name in templates.templates:
+            templates.templates[name].region = tuple(manifest[name]["region"])
+    return manifest
+
 def convert_to_number(text):
     if not text:
         return 0
@@ -170,332 +1406,953 @@ def convert_to_number(text):
         num *= 1_000_000_000
     return int(num)
 
-def ocr_resources_auto(image_path):
-    img = cv2.imread(image_path)
+RESOURCE_KEYS = ["Food", "Wood", "Stone", "Gold"]
+OCR_CONFIG = "-c tessedit_char_whitelist=0123456789.,KMB"
+
+def resource_crops(frame):
+    img = frame.image
     h, w, _ = img.shape
     x1, x2 = int(w * 0.63), int(w * 0.92)
     start_y = int(h * 0.33)
     row_height = int(h * 0.095)
+    zoom = 2 * REFERENCE_SIZE[0] / w
     crops = {}
-    keys = ["Food", "Wood", "Stone", "Gold"]
-    for i, key in enumerate(keys):
+    for i, key in enumerate(RESOURCE_KEYS):
         y1 = start_y + i * row_height
         y2 = y1 + row_height
         crop = img[y1:y2, x1:x2]
         gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
-        gray = cv2.resize(gray, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+        gray = cv2.resize(gray, None, fx=zoom, fy=zoom, interpolation=cv2.INTER_CUBIC)
         _, thresh = cv2.threshold(gray, 160, 255, cv2.THRESH_BINARY)
-        text = pytesseract.image_to_string(
-            thresh,
-            config="--psm 7 -c tessedit_char_whitelist=0123456789.,KMB"
-        ).strip()
-        match = re.search(r"[\d,]+(\.\d+)?[KMB]?", text)
-        value = match.group(0) if match else text
-        crops[key] = value
+        crops[key] = thresh
     return crops
 
-def handle_disconnect(device_id, paths):
-    global stop_gather_flag
-    if stop_gather_flag:
-        return False
+def clean_ocr_text(text):
+    text = text.strip()
+    match = re.search(r"[\d,]+(\.\d+)?[KMB]?", text)
+    return match.group(0) if match else text
+
+def normalize_glyph(image):
+    h, w = image.shape
+    canvas = np.zeros((h, max(w, h * GLYPH_SIZE[0] // GLYPH_SIZE[1])), np.uint8)
+    x = (canvas.shape[1] - w) // 2
+    canvas[:, x:x + w] = image
+    return cv2.resize(canvas, GLYPH_SIZE, interpolation=cv2.INTER_AREA)
+
+class GlyphRecognizer:
+    def __init__(self, path=GLYPHS_PATH):
+        self.path = path
+        self.glyphs = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            if os.path.isdir(self.path):
+                for file in sorted(os.listdir(self.path)):
+                    char = os.path.splitext(file)[0]
+                    if not file.endswith(".png") or char not in "0123456789KMB":
+                        continue
+                    image = cv2.imread(os.path.join(self.path, file), cv2.IMREAD_GRAYSCALE)
+                    if image is not None:
+                        self.glyphs[char] = normalize_glyph(image)
+            self.loaded = True
+
+    def segment(self, thresh):
+        count, _, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
+        boxes = sorted((tuple(stats[i][:4]) for i in range(1, count) if stats[i][4] >= 4),
+                       key=lambda box: box[0])
+        if not boxes:
+            return []
+        text_height = max(box[3] for box in boxes)
+        baseline = max(y + h for _, y, _, h in boxes if h > text_height * 0.6)
+        chars = []
+        for x, y, w, h in boxes:
+            if h < text_height * 0.5:
+                chars.append(("," if y + h > baseline + 1 else ".", None))
+            else:
+                chars.append((None, thresh[y:y + h, x:x + w]))
+        return chars
+
+    def read(self, thresh):
+        if not self.loaded:
+            self.load()
+        if not self.glyphs:
+            return None
+        text = ""
+        for char, image in self.segment(thresh):
+            if char is None:
+                glyph = normalize_glyph(image)
+                scores = {c: cv2.matchTemplate(glyph, g, cv2.TM_CCOEFF_NORMED)[0][0]
+                          for c, g in self.glyphs.items()}
+                char = max(scores, key=scores.get)
+                if not scores[char] >= GLYPH_MIN_SCORE:
+                    return None
+            text += char
+        return text or None
+
+    def learn(self, frame, values):
+        os.makedirs(self.path, exist_ok=True)
+        learned = set()
+        for key, value in zip(RESOURCE_KEYS, values):
+            digits = [c for c in value.upper() if c in "0123456789KMB"]
+            images = [image for char, image in self.segment(resource_crops(frame)[key]) if char is None]
+            if len(digits) != len(images):
+                continue
+            for char, image in zip(digits, images):
+                if char not in learned:
+                    cv2.imwrite(os.path.join(self.path, f"{char}.png"), normalize_glyph(image))
+                    learned.add(char)
+        self.glyphs = {}
+        self.loaded = False
+        return sorted(learned)
+
+glyphs = GlyphRecognizer(GLYPHS_PATH)
+
+def ocr_tesseract(crops):
+    import pytesseract
+    pytesseract.pytesseract.tesseract_cmd = TESSERACT_PATH
+    keys = list(crops)
+    pad = 10
+    width = max(crop.shape[1] for crop in crops.values()) + pad * 2
+    rows = []
+    for key in keys:
+        crop = crops[key]
+        row = np.zeros((crop.shape[0] + pad * 2, width), np.uint8)
+        row[pad:pad + crop.shape[0], pad:pad + crop.shape[1]] = crop
+        rows.append(row)
+    text = pytesseract.image_to_string(np.vstack(rows), config=f"--psm 6 {OCR_CONFIG}")
+    lines = [line for line in text.splitlines() if line.strip()]
+    if len(lines) == len(keys):
+        return {key: clean_ocr_text(line) for key, line in zip(keys, lines)}
+    return {key: clean_ocr_text(pytesseract.image_to_string(crops[key], config=f"--psm 7 {OCR_CONFIG}"))
+            for key in keys}
+
+def ocr_resources_auto(frame):
+    with tracer.span("ocr"):
+        crops = resource_crops(frame)
+        values = {key: glyphs.read(crop) for key, crop in crops.items()}
+        missing = {key: crops[key] for key, value in values.items() if value is None}
+        if missing:
+            values.update(ocr_tesseract(missing))
+        return values
+
+class DeviceSession:
+    def __init__(self, device_id, window, log_key):
+        self.device_id = device_id
+        self.window = window
+        self.log_key = log_key
+        self.stop_event = threading.Event()
+        self.frame = None
+        self.marches = 0
+        self.wait_count = 0
+        self.wait_seconds = 0.0
+        self.wait_timeouts = 0
+        self.thread = None
+        self.started_at = time.time()
+
+    def stopped(self):
+        return self.stop_event.is_set()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def sleep(self, seconds):
+        with tracer.span("sleep"):
+            return not self.stop_event.wait(seconds)
+
+    def set_step(self, step):
+        tracer.set_step(step)
+
+    def capture(self):
+        self.frame = capture_frame(self.device_id)
+        return self.frame
+
+    def tap(self, x, y, repeat=1, interval=0):
+        adb_tap_batch(self.device_id, [(x, y)] * repeat, interval)
+
+    def back(self):
+        with tracer.span("tap"):
+            adb_command("-s", self.device_id, "shell", "input", "keyevent", "4")
+
+    def log(self, message):
+        log_pipeline.emit(self.log_key, self.device_id, message, self.started_at)
+        self.window.write_event_value(self.log_key, f"[{self.device_id}] {message}")
+
+    def wait_until(self, target, timeout=WAIT_TIMEOUT, step=None, threshold=0.85, settle=WAIT_SETTLE):
+        if callable(target):
+            check = target
+        elif isinstance(target, str):
+            check = lambda frame: find_image(target, frame, threshold)
+        else:
+            check = lambda frame: detect_any(frame, target, threshold)
+
+        self.set_step(step or str(target))
+        start = time.time()
+        delay = WAIT_MIN_INTERVAL
+        result = None
+        with tracer.span("wait"):
+            active = self.sleep(settle)
+            while active:
+                frame = handle_disconnect(self)
+                if frame is not None and (result := check(frame)):
+                    break
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    break
+                active = self.sleep(min(delay, remaining))
+                delay = min(delay * 2, WAIT_MAX_INTERVAL)
+        self.wait_count += 1
+        self.wait_seconds += time.time() - start
+        self.wait_timeouts += not result
+        return result or None
+
+    def wait_summary(self):
+        if not self.wait_count:
+            return "Không có bước chờ nào."
+        return (f"Thời gian chờ: {self.wait_count} bước, tổng {self.wait_seconds:.1f}s, "
+                f"trung bình {self.wait_seconds / self.wait_count:.2f}s, {self.wait_timeouts} lần hết giờ")
+
+    def record_march(self):
+        self.marches += 1
+        tracer.record_march(self.device_id)
+        self.window.write_event_value('-GATHER-STATS-', self.device_id)
+
+    def marches_per_hour(self):
+        hours = (time.time() - self.started_at) / 3600
+        return self.marches / hours if hours > 0 else 0.0
+
+    def stats(self):
+        seconds = tracer.summary(self.device_id)
+        return (seconds.get("sleep", 0.0), seconds.get("screencap", 0.0),
+                seconds.get("match", 0.0), self.marches_per_hour())
+
+class DeviceScheduler:
+    def __init__(self, max_workers=MAX_DEVICE_WORKERS):
+        self.slots = threading.BoundedSemaphore(max_workers)
+        self.sessions = {}
+        self.started_at = None
+        self.keep = False
+        self.lock = threading.Lock()
+
+    def start(self, device_ids, job, window, log_key, *args):
+        with self.lock:
+            if not self.running() and not self.keep:
+                self.sessions = {}
+                self.started_at = time.time()
+            started = []
+            for device_id in device_ids:
+                if (previous := self.sessions.get(device_id)) and previous.thread.is_alive():
+                    continue
+                session = DeviceSession(device_id, window, log_key)
+                if previous:
+                    session.marches, session.started_at = previous.marches, previous.started_at
+                session.thread = threading.Thread(target=self._run, args=(session, job, args), daemon=True)
+                self.sessions[device_id] = session
+                session.thread.start()
+                started.append(device_id)
+            return started
+
+    def reset(self):
+        with self.lock:
+            self.sessions = {device_id: session for device_id, session in self.sessions.items()
+                             if session.thread.is_alive()}
+            self.started_at = time.time()
+
+    def _run(self, session, job, args):
+        with self.slots:
+            if not session.stopped():
+                tracer.bind(session.device_id)
+                job(session, *args)
+
+    def stop(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.stop()
+
+    def running(self):
+        return any(session.thread.is_alive() for session in self.sessions.values())
+
+    def active_devices(self):
+        return [device_id for device_id, session in self.sessions.items() if session.thread.is_alive()]
+
+    def marches(self):
+        return sum(session.marches for session in self.sessions.values())
+
+    def marches_per_hour(self):
+        if self.started_at is None:
+            return 0.0
+        hours = (time.time() - self.started_at) / 3600
+        return self.marches() / hours if hours > 0 else 0.0
+
+gather_scheduler = DeviceScheduler()
+clear_fog_scheduler = DeviceScheduler()
+
+def handle_disconnect(session):
+    if session.stopped():
+        return None
     
-    adb_screencap(device_id)
+    frame = session.capture()
     
-    if find_image(paths["disconnect"], screenshot_path=SCREENSHOT_PATH, threshold=0.9):
-        confirm_coord = find_image(paths["confirm"], screenshot_path=SCREENSHOT_PATH)
+    if find_image("disconnect", frame, threshold=0.9):
+        screen_index.add("disconnect", frame)
+        confirm_coord = find_image("confirm", frame)
         if confirm_coord:
-            adb_tap(device_id, *confirm_coord)
-            time.sleep(30)
+            session.tap(*confirm_coord)
+            session.sleep(30)
         else:
-            time.sleep(30)
-    return True
+            session.sleep(30)
+        if session.stopped():
+            return None
+        frame = session.capture()
+    return frame
 
-def gather_rss_thread(device_id, window, max_marches=6):
-    global stop_gather_flag
-    stop_gather_flag = False
-    
-    paths = {name: os.path.join(DATA_PATH, f"{name}.png") for name in
-             ["home", "map", "item", "task", "info", "exit", "find",
-              "food", "wood", "stone", "gold", "up", "down",
-              "search", "gather", "newtroop", "march",
-              "disconnect", "confirm"]} 
+GATHER_FLOW = {
+    "name": "gather",
+    "states": {
+        "march_panel": {"detect": ["march"], "transitions": [
+            {"tap": "march", "next": ["world"], "then": "march_sent"},
+        ]},
+        "troops": {"detect": ["newtroop"], "transitions": [
+            {"tap": "newtroop", "next": ["march_panel"],
+             "log": "Còn đạo quân, tiến hành gửi quân đi thu thập..."},
+        ]},
+        "mine": {"detect": ["gather"], "transitions": [
+            {"tap": "gather", "next": ["troops"], "on_timeout": "out_of_troops",
+             "log": "Tìm thấy mỏ, tiến hành thu thập..."},
+        ]},
+        "level": {"detect": ["search"], "transitions": [
+            {"when": ["marches_left", "resource_unselected"], "if_seen": ["{resource}"], "tap": "{resource}", "next": ["level"], "then": "resource_selected",
+             "log": "Chọn {resource_name}..."},
+            {"when": ["marches_left", "level_unset"], "tap": "up", "repeat": MINE_LEVEL_STEPS, "interval": 0.25, "next": ["level"],
+             "then": "level_set", "log": "Đang tăng level mỏ..."},
+            {"when": ["marches_left", "level_too_high"], "tap": "down", "repeat": "{steps}", "interval": 0.25, "next": ["level"],
+             "settle": 0.25, "then": "level_lowered", "log": "Đang giảm level mỏ {steps} bậc..."},
+            {"when": "marches_left", "tap": "search", "next": ["mine"], "step": "search attempt {attempt}", "then": "mine_found",
+             "on_timeout": "search_missed", "log": "Đang tìm mỏ..."},
+        ]},
+        "search_panel": {"detect": ["food", "wood", "stone", "gold"], "transitions": [
+            {"when": "marches_left", "tap": "{resource}", "next": ["level"], "then": "resource_selected", "log": "Chọn {resource_name}..."},
+        ]},
+        "bag": {"detect": ["info"], "transitions": [
+            {"when": "need_resources", "tap": "info", "next": ["resources"], "settle": 5, "then": "resources_opened",
+             "log": "Đang mở bảng tài nguyên..."},
+            {"tap": "exit", "next": ["city", "resources"], "settle": 1},
+        ]},
+        "resources": {"detect": ["exit"], "enter": "read_resources", "transitions": [
+            {"tap": "exit", "next": ["bag", "city"], "settle": 1, "log": "Đang trở về bản đồ..."},
+        ]},
+        "city": {"detect": ["map"], "final": True, "transitions": [
+            {"when": "need_resources", "tap": "item", "fallback": "task", "next": ["bag"],
+             "log": "Đang mở túi đồ..."},
+            {"when": "marches_left", "tap": "map", "next": ["world"]},
+        ]},
+        "world": {"detect": ["home"], "threshold": 0.9, "final": True, "transitions": [
+            {"when": "need_resources", "tap": "home", "next": ["city"], "timeout": 10,
+             "log": "Đang trở về thành phố..."},
+            {"when": "marches_left", "tap": "find", "next": ["search_panel", "level"],
+             "log": "Đạo quân {march}/{max_marches} | Thu thập {resource_name}"},
+        ]},
+    },
+}
 
-    window.write_event_value('-GATHER-LOG-', "🌸 Bắt Đầu Thu Thập Tài Nguyên 🌸")
-    
-    if not handle_disconnect(device_id, paths):
-        return
-    
-    adb_screencap(device_id)
-    if home_coord := find_image(paths["home"], threshold=0.9):
-        window.write_event_value('-GATHER-LOG-', "Đang trở về thành phố...")
-        adb_tap(device_id, *home_coord)
-        time.sleep(5)
-    else:
-        window.write_event_value('-GATHER-LOG-', "Đã ở trong thành phố.")
-    
-    time.sleep(5)
-    if not handle_disconnect(device_id, paths):
-        return
-    
-    adb_screencap(device_id)
-    window.write_event_value('-GATHER-LOG-', "Đang mở túi đồ...")
-    item_coord = find_image(paths["item"])
-    if not item_coord:
-        window.write_event_value('-GATHER-LOG-', "Không tìm thấy túi đồ, đang mở task và thử lại...")
-        if task_coord := find_image(paths["task"]):
-            adb_tap(device_id, *task_coord)
-            time.sleep(5)
-            if not handle_disconnect(device_id, paths):
-                return
-            adb_screencap(device_id)
-            item_coord = find_image(paths["item"])
-        if not item_coord:
-            window.write_event_value('-GATHER-LOG-', "Không thể mở túi đồ!")
-            return
-    
-    adb_tap(device_id, *item_coord)
-    time.sleep(5)
-    
-    if not handle_disconnect(device_id, paths):
-        return
-    
-    adb_screencap(device_id)
-    window.write_event_value('-GATHER-LOG-', "Đang mở bảng tài nguyên...")
-    if info_coord := find_image(paths["info"]):
-        adb_tap(device_id, *info_coord)
-        time.sleep(5)
-    else:
-        window.write_event_value('-GATHER-LOG-', "Không tìm thấy nút thông tin!")
-        return
+CLEAR_FOG_FLOW = {
+    "name": "clear fog",
+    "states": {
+        "send_panel": {"detect": ["send"], "transitions": [
+            {"tap": "send", "next": ["city", "world"], "settle": 1.5, "then": "scout_sent"},
+        ]},
+        "select": {"detect": ["selected", "notselected"], "require": ["explore"], "transitions": [
+            {"if_seen": ["notselected"], "tap": "notselected", "next": ["select"], "settle": 0.8},
+            {"tap": "explore", "next": ["send_panel"], "settle": 2},
+        ]},
+        "scout_panel": {"detect": ["explore"], "transitions": [
+            {"tap": "explore", "next": ["select", "send_panel"], "settle": 1.5},
+        ]},
+        "camp": {"detect": ["scout"], "transitions": [
+            {"tap": "scout", "next": ["scout_panel"], "settle": 1.5},
+        ]},
+        "city": {"detect": ["map"], "transitions": [
+            {"when": "needs_recenter", "tap": "map", "next": ["world"], "settle": 1.5},
+            {"when": "camp_available", "at": "next_camp", "next": ["camp", "scout_panel"], "settle": 1.5,
+             "on_timeout": "camp_missed"},
+            {"when": "idle", "tap": "map", "next": ["world"], "settle": 1.5},
+        ]},
+        "world": {"detect": ["home"], "transitions": [
+            {"tap": "home", "next": ["city"], "settle": 1.5, "then": "recentered"},
+        ]},
+    },
+}
 
-    window.write_event_value('-GATHER-LOG-', "Đang đọc số liệu tài nguyên...")
-    if not handle_disconnect(device_id, paths):
-        return
-    
-    adb_screencap(device_id)
-    resources = ocr_resources_auto(SCREENSHOT_PATH)
-    window.write_event_value('-GATHER-LOG-', f"Tài nguyên: {resources}")
-    numeric_resources = {k: convert_to_number(v) for k, v in resources.items()}
-    sorted_res = sorted(numeric_resources.items(), key=lambda x: x[1])
-
-    window.write_event_value('-GATHER-LOG-', "Đang trở về bản đồ...")
-    for _ in range(2):
-        if not handle_disconnect(device_id, paths):
-            return
-        if exit_coord := find_image(paths["exit"]):
-            adb_tap(device_id, *exit_coord)
-            time.sleep(2)
-            adb_screencap(device_id)
-    
-    if map_coord := find_image(paths["map"]):
-        adb_tap(device_id, *map_coord)
-    time.sleep(5)
-
-    count = 0
-    while count < max_marches and not stop_gather_flag:
-        res_name, res_value = sorted_res[count % len(sorted_res)]
-        if res_value == 0:
-            window.write_event_value('-GATHER-LOG-', f"Không tìm thấy {res_name}, bỏ qua...")
-            count += 1
-            continue
+class FlowRunner:
+    def __init__(self, session, flow, context):
+        self.session = session
+        self.flow = flow
+        self.states = flow["states"]
+        self.context = context
 
-        window.write_event_value('-GATHER-LOG-', f"Đạo quân {count + 1}/{max_marches} | Thu thập {res_name}")
-        
-        if not handle_disconnect(device_id, paths):
-            return
-        
-        adb_screencap(device_id)
-        if not (find_coord := find_image(paths["find"])):
-            window.write_event_value('-GATHER-LOG-', "Không tìm thấy nút tìm kiếm!")
-            return
-        adb_tap(device_id, *find_coord)
-        time.sleep(5)
+    def format(self, text):
+        return text.format_map(vars(self.context))
 
-        window.write_event_value('-GATHER-LOG-', f"Chọn {res_name}...")
-        if not handle_disconnect(device_id, paths):
-            return
-        
-        adb_screencap(device_id)
-        if not (res_coord := find_image(paths[res_name.lower()])):
-            window.write_event_value('-GATHER-LOG-', f"Không tìm thấy {res_name}!")
-            return
-        adb_tap(device_id, *res_coord)
-        time.sleep(5)
+    def hook(self, name):
+        return getattr(self.context, name)(self.session) if name else None
 
-        window.write_event_value('-GATHER-LOG-', "Đang tăng level mỏ...")
-        for _ in range(6):
-            if not handle_disconnect(device_id, paths):
-                return
-            adb_screencap(device_id)
-            if up_coord := find_image(paths["up"]):
-                adb_tap(device_id, *up_coord)
-                time.sleep(0.25)
+    def matches(self, name, frame):
+        state = self.states[name]
+        threshold = state.get("threshold", 0.85)
+        return bool(detect_any(frame, state["detect"], threshold)) and all(
+            find_image(required, frame, threshold) for required in state.get("require", []))
 
-        window.write_event_value('-GATHER-LOG-', "Đang tìm mỏ...")
-        if not handle_disconnect(device_id, paths):
-            return
-        
-        adb_screencap(device_id)
-        if not (search_coord := find_image(paths["search"])):
-            window.write_event_value('-GATHER-LOG-', "Không thấy nút tìm mỏ!")
+    def classify(self, frame, names=None):
+        if frame is None:
+            return None
+        names = names or list(self.states)
+        predicted = screen_index.predict(frame)
+        found = None
+        if predicted in names and self.matches(predicted, frame):
+            names, found = names[:names.index(predicted)], predicted
+        for name in names:
+            if name != predicted and self.matches(name, frame):
+                self.learn(name, frame)
+                return name
+        return found
+
+    def learn(self, name, frame):
+        if screen_index.count(name) >= SCREEN_REFERENCES:
             return
-        adb_tap(device_id, *search_coord)
-        
-        found_gather = False
-        max_attempts = 6
-        for attempt in range(max_attempts):
-            if stop_gather_flag:
-                window.write_event_value('-GATHER-LOG-', "Đã dừng thu thập tài nguyên!")
+        for other in self.states:
+            if other == name:
+                screen_index.add(name, frame)
                 return
-                
-            time.sleep(5)
-            if not handle_disconnect(device_id, paths):
-                return
-            
-            adb_screencap(device_id)
-            if gather_coord := find_image(paths["gather"]):
-                adb_tap(device_id, *gather_coord)
-                found_gather = True
-                window.write_event_value('-GATHER-LOG-', "Tìm thấy mỏ, tiến hành thu thập...")
-                break
-            else:
-                window.write_event_value('-GATHER-LOG-', f"Đang giảm level mỏ và tìm lại... ({attempt + 2}/{max_attempts})")
-                if down_coord := find_image(paths["down"]):
-                    adb_tap(device_id, *down_coord)
-                    time.sleep(0.25)
-                
-                if not handle_disconnect(device_id, paths):
-                    return
-                
-                adb_screencap(device_id)
-                if search_coord := find_image(paths["search"]):
-                    adb_tap(device_id, *search_coord)
-                else:
-                    window.write_event_value('-GATHER-LOG-', "Không tìm thấy nút tìm mỏ để thử lại!")
-                    break
-    
-        if found_gather:
-            window.write_event_value('-GATHER-LOG-', "Đang kiểm tra đạo quân...")
-            time.sleep(5)
-            if not handle_disconnect(device_id, paths):
+            if self.matches(other, frame):
                 return
-            
-            adb_screencap(device_id)
-            if newtroop_coord := find_image(paths["newtroop"]):
-                window.write_event_value('-GATHER-LOG-', "Còn đạo quân, tiến hành gửi quân đi thu thập...")
-                adb_tap(device_id, *newtroop_coord)
-                time.sleep(5)
-
-                if not handle_disconnect(device_id, paths):
-                    return
-                
-                adb_screencap(device_id)
-                if march_coord := find_image(paths["march"]):
-                    adb_tap(device_id, *march_coord)
-                    window.write_event_value('-GATHER-LOG-', "Đã gửi quân đi thu thập!")
-                    time.sleep(5)
-                    count += 1
-                else:
-                    window.write_event_value('-GATHER-LOG-', "Không thể gửi quân!")
-                    return
+
+    def targets(self, transition):
+        tap = transition["tap"]
+        return [self.format(name) for name in ([tap] if isinstance(tap, str) else tap)]
+
+    def choose(self, state, frame):
+        for index, transition in enumerate(state["transitions"]):
+            when = transition.get("when", [])
+            if not all(self.hook(name) for name in ([when] if isinstance(when, str) else when)):
+                continue
+            if (seen := transition.get("if_seen")) and not detect_any(frame, [self.format(name) for name in seen]):
+                continue
+            return index, transition
+        return None, None
+
+    def press(self, transition, step):
+        if at := transition.get("at"):
+            self.session.tap(*self.hook(at))
+            return True
+        names = self.targets(transition)
+        hit = self.session.wait_until(names, step=step, settle=0)
+        if not hit and (fallback := transition.get("fallback")):
+            if fallback_hit := detect_any(self.session.frame, [fallback]):
+                self.session.tap(*fallback_hit.center)
+                hit = self.session.wait_until(names, step=step)
+        if not hit:
+            return False
+        if isinstance(repeat := transition.get("repeat", 1), str):
+            repeat = int(self.format(repeat))
+        self.session.tap(*hit.center, repeat=repeat, interval=transition.get("interval", 0))
+        return True
+
+    def recover(self, expected):
+        frame = self.session.frame
+        if (current := self.classify(frame)) is not None:
+            self.session.log(f"Màn hình không như dự kiến ({', '.join(expected)}), chuyển sang {current}")
+            return current
+        if exit_hit := detect_any(frame, ["exit"]):
+            self.session.tap(*exit_hit.center)
+        else:
+            self.session.back()
+        self.session.sleep(1)
+        return None
+
+    def run(self):
+        current = None
+        entered = None
+        failures = 0
+        repeats = 0
+        last = None
+        while not self.session.stopped():
+            if failures > FLOW_MAX_RECOVERIES:
+                self.session.log(f"Không thể tiếp tục {self.flow['name']}, dừng lại!")
+                return False
+
+            if current is None:
+                frame = handle_disconnect(self.session)
+                if frame is None:
+                    return False
+                if (current := self.classify(frame)) is None:
+                    failures += 1
+                    current = self.recover(list(self.states))
+                    continue
+
+            state = self.states[current]
+            self.session.set_step(current)
+            if current != entered:
+                entered = current
+                if result := self.hook(state.get("enter")):
+                    if result == "done":
+                        return True
+                    current = result
+                    continue
+
+            index, transition = self.choose(state, self.session.frame)
+            if transition is None:
+                if state.get("final"):
+                    return True
+                failures += 1
+                self.session.back()
+                self.session.sleep(1)
+                current = None
+                continue
+            repeats = repeats + 1 if last == (current, index) else 0
+            last = (current, index)
+            if repeats >= FLOW_MAX_REPEATS:
+                self.session.log(f"Lặp lại quá nhiều lần ở {current}, thử khôi phục...")
+                failures += 1
+                repeats = 0
+                current = None
+                continue
+
+            step = self.format(transition.get("step", current))
+            if message := transition.get("log"):
+                self.session.log(self.format(message))
+            expected = transition["next"]
+            reached = None
+            if self.press(transition, step):
+                reached = self.session.wait_until(lambda frame: self.classify(frame, expected),
+                                                  timeout=transition.get("timeout", WAIT_TIMEOUT), step=step,
+                                                  settle=transition.get("settle", WAIT_SETTLE))
+            if self.session.stopped():
+                return False
+            if reached:
+                self.hook(transition.get("then"))
+                current = reached
+                failures = 0
+            elif on_timeout := transition.get("on_timeout"):
+                if (result := self.hook(on_timeout)) == "done":
+                    return True
+                current = result or self.classify(self.session.frame)
             else:
-                window.write_event_value('-GATHER-LOG-', "Hết đạo quân trống. Kết thúc!")
+                failures += 1
+                current = self.recover(expected)
+        return False
+
+class MineLevels:
+    def __init__(self, path):
+        self.path = path
+        self.levels = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                self.levels = json.load(f)
+
+    def save(self):
+        with self.lock:
+            if not self.levels:
                 return
-        else:
-            window.write_event_value('-GATHER-LOG-', f"Không tìm thấy mỏ {res_name}, chuyển sang lượt sau...")
-            count += 1
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(self.levels, f, indent=4)
 
-    if count >= max_marches:
-        window.write_event_value('-GATHER-LOG-', f"Đã gửi đủ {max_marches} đạo quân. Hoàn thành!")
-    else:
-        window.write_event_value('-GATHER-LOG-', "Đã dừng thu thập tài nguyên!")
+    def entry(self, device_id, resource):
+        resources = self.levels.setdefault(device_id, {})
+        if "results" not in resources.get(resource, {}):
+            resources[resource] = {"results": {}, "checked": {}}
+        return resources[resource]
 
-def clear_fog_thread(device_id, window):
-    global stop_clear_fog_flag
-    stop_clear_fog_flag = False
-    
-    templates = {}
-    for file in os.listdir(DATA_PATH):
-        path = os.path.join(DATA_PATH, file)
-        if file.endswith(".png") and os.path.isfile(path):
-            templates[file] = cv2.imread(path)
-
-    def adb_screencap(device_id, output=SCREENSHOT_PATH):
-        with open(output, "wb") as f:
-            subprocess.run(
-                [ADB_PATH, "-s", device_id, "exec-out", "screencap", "-p"],
-                stdout=f, stderr=subprocess.DEVNULL
-            )
-
-    def adb_tap(device_id, x, y):
-        subprocess.run(
-            [ADB_PATH, "-s", device_id, "shell", "input", "tap", str(x), str(y)],
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-        )
-
-    def find_image(filename, screenshot_path=SCREENSHOT_PATH, threshold=0.85):
-        if filename not in templates:
+    def start(self, device_id, resource):
+        now = time.time()
+        with self.lock:
+            entry = self.entry(device_id, resource)
+            for depth in range(MINE_LEVEL_STEPS - 1):
+                results = entry["results"].get(str(depth), [])
+                if (len(results) < MINE_LEVEL_MIN_TRIES or sum(results) / len(results) >= MINE_LEVEL_MIN_RATE
+                        or now - entry["checked"].get(str(depth), 0) >= MINE_LEVEL_RECHECK):
+                    return depth
+            return MINE_LEVEL_STEPS - 1
+
+    def record(self, device_id, resource, depth, found):
+        with self.lock:
+            entry = self.entry(device_id, resource)
+            results = entry["results"].get(str(depth), []) + [int(found)]
+            entry["results"][str(depth)] = results[-MINE_LEVEL_WINDOW:]
+            entry["checked"][str(depth)] = time.time()
+
+mine_levels = MineLevels(MINE_LEVELS_PATH)
+
+class ResourceStore:
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS snapshots (device TEXT, ts REAL, "
+                            + ", ".join(f"{key.lower()} INTEGER" for key in RESOURCE_KEYS) + ")")
+            self.db.execute("CREATE INDEX IF NOT EXISTS snapshots_device_ts ON snapshots (device, ts)")
+        return self.db
+
+    def record(self, device_id, resources, ts=None):
+        if not any(resources.values()):
+            return
+        with self.lock:
+            db = self.connect()
+            db.execute(f"INSERT INTO snapshots VALUES (?, ?{', ?' * len(RESOURCE_KEYS)})",
+                       [device_id, ts or time.time()] + [int(resources.get(key, 0)) for key in RESOURCE_KEYS])
+            db.commit()
+
+    def history(self, device_id, since=0):
+        with self.lock:
+            rows = self.connect().execute("SELECT * FROM snapshots WHERE device = ? AND ts >= ? ORDER BY ts",
+                                          (device_id, since)).fetchall()
+        return [(ts, dict(zip(RESOURCE_KEYS, values))) for _, ts, *values in rows]
+
+    def latest(self, device_id, max_age=RESOURCE_TTL):
+        history = self.history(device_id, time.time() - max_age)
+        return history[-1] if history else None
+
+    def devices(self):
+        with self.lock:
+            return [row[0] for row in self.connect().execute("SELECT DISTINCT device FROM snapshots ORDER BY device")]
+
+    def rates(self, device_id, hours=24):
+        history = self.history(device_id, time.time() - hours * 3600)
+        if len(history) < 2 or history[-1][0] <= history[0][0]:
             return None
-        img_rgb = cv2.imread(screenshot_path)
-        template = templates[filename]
-        if img_rgb is None or template is None:
+        (start, first), (end, last) = history[0], history[-1]
+        return {key: (last[key] - first[key]) * 3600 / (end - start) for key in RESOURCE_KEYS}
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+resource_store = ResourceStore(RESOURCE_DB_PATH)
+
+class GatherPlan:
+    def __init__(self, max_marches):
+        self.max_marches = max_marches
+        self.resources = None
+        self.count = 0
+        self.march = 1
+        self.resource = ""
+        self.resource_name = ""
+        self.attempt = 1
+        self.selected = False
+        self.level_ready = False
+        self.depth = 0
+        self.lowered = 0
+        self.steps = 0
+        self.max_attempts = 6
+        self.idle = True
+        self.sent_at = []
+        self.panel_open = False
+
+    def need_resources(self, session):
+        return self.resources is None
+
+    def marches_left(self, session):
+        return self.resources is not None and self.count < self.max_marches
+
+    def resources_opened(self, session):
+        self.panel_open = True
+
+    def read_resources(self, session):
+        if self.resources is not None or not self.panel_open:
             return None
-        res = cv2.matchTemplate(img_rgb, template, cv2.TM_CCOEFF_NORMED)
-        _, max_val, _, max_loc = cv2.minMaxLoc(res)
-        if max_val >= threshold:
-            cx = int(max_loc[0] + template.shape[1] / 2)
-            cy = int(max_loc[1] + template.shape[0] / 2)
-            return (cx, cy)
+        self.panel_open = False
+        session.log("Đang đọc số liệu tài nguyên...")
+        resources = ocr_resources_auto(session.frame)
+        session.log(f"Tài nguyên: {resources}")
+        numeric_resources = {k: convert_to_number(v) for k, v in resources.items()}
+        resource_store.record(session.device_id, numeric_resources)
+        self.use_resources(session, numeric_resources)
         return None
 
-    def wait_and_click(filename, must=True, delay=1, threshold=0.85):
-        nonlocal device_id
-        while not stop_clear_fog_flag:
-            adb_screencap(device_id)
-            coord = find_image(filename, threshold=threshold)
-            if coord:
-                adb_tap(device_id, *coord)
-                time.sleep(delay)
-                return True
-            if not must:
-                return False
-            time.sleep(0.3)
-        return False
+    def use_resources(self, session, numeric_resources):
+        self.resources = sorted(numeric_resources.items(), key=lambda x: x[1])
+        self.next_march(session)
 
-    window.write_event_value('-CLEARFOG-LOG-', "🌸 Bắt Đầu Clear Fog 🌸")
-
-    while not stop_clear_fog_flag:
-        adb_screencap(device_id)
-        if (coord := find_image("home.png")):
-            adb_tap(device_id, *coord); time.sleep(1.5)
-        elif (coord := find_image("map.png")):
-            adb_tap(device_id, *coord); time.sleep(1.5)
-            adb_screencap(device_id)
-            if (coord2 := find_image("home.png")):
-                adb_tap(device_id, *coord2); time.sleep(1.5)
-
-        adb_screencap(device_id)
-        target = None
-        for i in range(1, 4):
-            coord = find_image(f"{i}.png")
-            if coord:
-                target = coord; break
-        if not target:
-            continue
+    def next_march(self, session):
+        self.selected = self.level_ready = False
+        self.attempt = 1
+        while self.resources and self.count < self.max_marches:
+            res_name, res_value = self.resources[self.count % len(self.resources)]
+            if res_value:
+                self.resource, self.resource_name = res_name.lower(), res_name
+                self.march = self.count + 1
+                self.depth = mine_levels.start(session.device_id, self.resource)
+                return
+            session.log(f"Không tìm thấy {res_name}, bỏ qua...")
+            self.count += 1
+
+    def resource_unselected(self, session):
+        return not self.selected
+
+    def resource_selected(self, session):
+        self.selected = True
+
+    def level_unset(self, session):
+        return not self.level_ready
+
+    def level_set(self, session):
+        self.level_ready = True
+        self.lowered = 0
+
+    def level_too_high(self, session):
+        self.steps = self.depth - self.lowered
+        return self.steps > 0
+
+    def level_lowered(self, session):
+        self.lowered = self.depth
+
+    def mine_found(self, session):
+        mine_levels.record(session.device_id, self.resource, self.depth, True)
 
-        adb_tap(device_id, *target); time.sleep(1.5)
-        wait_and_click("scout.png", must=False, delay=1.5)
-        wait_and_click("explore.png", must=True, delay=1.5)
+    def search_missed(self, session):
+        mine_levels.record(session.device_id, self.resource, self.depth, False)
+        if self.attempt >= self.max_attempts or self.depth >= MINE_LEVEL_STEPS - 1:
+            session.log(f"Không tìm thấy mỏ {self.resource_name}, chuyển sang lượt sau...")
+            self.count += 1
+            self.next_march(session)
+            return None
+        self.attempt += 1
+        self.depth += 1
+        session.log(f"Đang giảm level mỏ và tìm lại... ({self.attempt}/{self.max_attempts})")
+        return None
+
+    def out_of_troops(self, session):
+        session.log("Hết đạo quân trống. Kết thúc!")
+        self.idle = False
+        return "done"
+
+    def march_sent(self, session):
+        session.log("Đã gửi quân đi thu thập!")
+        session.record_march()
+        self.sent_at.append(time.time())
+        self.count += 1
+        self.next_march(session)
+
+class ClearFogPlan:
+    def __init__(self):
+        self.recenter = True
+        self.scouts = 0
+        self.camps = deque()
+        self.delay = FOG_IDLE_MIN
+
+    def needs_recenter(self, session):
+        return self.recenter
+
+    def recentered(self, session):
+        self.recenter = False
+
+    def camp_available(self, session):
+        if not self.camps:
+            hits = detect_all(session.frame, FOG_CAMPS, max_hits=FOG_MAX_CAMPS)
+            self.camps.extend(hit.center for hit in sorted(hits, key=lambda hit: hit.center))
+        return bool(self.camps)
+
+    def next_camp(self, session):
+        return self.camps.popleft()
+
+    def camp_missed(self, session):
+        self.camps.clear()
+        self.recenter = True
+
+    def idle(self, session):
+        session.log(f"Không thấy trại trinh sát, chờ {self.delay}s...")
+        session.sleep(self.delay)
+        self.delay = min(self.delay * 2, FOG_IDLE_MAX)
+        return True
+
+    def scout_sent(self, session):
+        self.scouts += 1
+        self.delay = FOG_IDLE_MIN
+        self.recenter = not self.camps
+
+def gather_rss_thread(session, max_marches=6):
+    session.log("🌸 Bắt Đầu Thu Thập Tài Nguyên 🌸")
+    plan = GatherPlan(max_marches)
+    if snapshot := resource_store.latest(session.device_id):
+        ts, resources = snapshot
+        session.log(f"Dùng số liệu tài nguyên lúc {time.strftime('%H:%M:%S', time.localtime(ts))}: {resources}")
+        plan.use_resources(session, resources)
+    FlowRunner(session, GATHER_FLOW, plan).run()
+    mine_levels.save()
+    session.log(session.wait_summary())
+    if plan.count >= max_marches:
+        session.log(f"Đã gửi đủ {max_marches} đạo quân. Hoàn thành!")
+    else:
+        session.log("Đã dừng thu thập tài nguyên!")
+    return plan
+
+def clear_fog_thread(session):
+    session.log("🌸 Bắt Đầu Clear Fog 🌸")
+    FlowRunner(session, CLEAR_FOG_FLOW, ClearFogPlan()).run()
+    session.log("🛑 Đã dừng Clear Fog!")
 
-        adb_screencap(device_id)
-        if not find_image("selected.png"):
-            if (coord := find_image("notselected.png")):
-                adb_tap(device_id, *coord); time.sleep(0.8)
+class GatherQueue:
+    def __init__(self, scheduler, return_time=MARCH_RETURN_TIME, retry_delay=MARCH_RETRY_DELAY):
+        self.scheduler = scheduler
+        self.return_time = return_time
+        self.retry_delay = retry_delay
+        self.heap = []
+        self.wakes = {}
+        self.returns = {}
+        self.durations = {}
+        self.window = None
+        self.log_key = None
+        self.max_marches = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.condition = threading.Condition()
+
+    def start(self, device_ids, window, log_key, max_marches):
+        with self.condition:
+            if not self.running():
+                self.heap = []
+                self.wakes = {}
+                self.returns = {}
+                self.stop_event = threading.Event()
+                self.scheduler.reset()
+                self.scheduler.keep = True
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+            self.window, self.log_key, self.max_marches = window, log_key, max_marches
+            active = set(self.scheduler.active_devices())
+            for device_id in device_ids:
+                if device_id not in self.wakes and device_id not in active:
+                    self._push(device_id, time.time())
+            self.condition.notify()
+
+    def _push(self, device_id, wake_at):
+        self.wakes[device_id] = wake_at
+        heapq.heappush(self.heap, (wake_at, device_id))
+
+    def schedule(self, device_id, wake_at):
+        with self.condition:
+            if not self.stop_event.is_set():
+                self._push(device_id, wake_at)
+                self.condition.notify()
+
+    def pending(self):
+        with self.condition:
+            return len(self.wakes)
+
+    def _loop(self):
+        with self.condition:
+            while not self.stop_event.is_set():
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                wake_at, device_id = self.heap[0]
+                if self.wakes.get(device_id) != wake_at:
+                    heapq.heappop(self.heap)
+                    continue
+                if (delay := wake_at - time.time()) > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+                del self.wakes[device_id]
+                self.scheduler.start([device_id], self._run, self.window, self.log_key)
+
+    def _run(self, session):
+        device_id = session.device_id
+        wake_at = time.time()
+        while wake_at is not None and wake_at - time.time() < WAIT_MIN_INTERVAL and not session.stopped():
+            if (delay := wake_at - time.time()) > 0:
+                session.sleep(delay)
+            wake_at = self.gather(session)
+        if wake_at is not None and not session.stopped():
+            session.log(f"Đạo quân tiếp theo về lúc {time.strftime('%H:%M:%S', time.localtime(wake_at))}, "
+                        f"sẽ gửi lại khi có quân trống")
+            self.schedule(device_id, wake_at)
+
+    def gather(self, session):
+        now = time.time()
+        device_id = session.device_id
+        pending = sorted(t for t in self.returns.get(device_id, []) if t > now)
+        due = len(self.returns.get(device_id, [])) - len(pending)
+        budget = self.max_marches - len(pending)
+        if budget <= 0:
+            return pending[0]
+        plan = gather_rss_thread(session, budget)
+        if session.stopped():
+            return None
+        duration = self.durations.get(device_id, self.return_time)
+        if due and not plan.sent_at and not plan.idle:
+            duration += self.retry_delay
+            self.durations[device_id] = duration
+            pending += [now + self.retry_delay] * due
+        elif due and plan.sent_at and duration > self.return_time:
+            duration = max(self.return_time, duration - self.retry_delay)
+            self.durations[device_id] = duration
+        pending = sorted(pending + [t + duration for t in plan.sent_at])
+        self.returns[device_id] = pending
+        if len(pending) >= self.max_marches or (pending and not plan.idle):
+            return pending[0]
+        return time.time() + self.retry_delay
+
+    def stop(self):
+        with self.condition:
+            self.stop_event.set()
+            self.heap = []
+            self.wakes = {}
+            self.scheduler.keep = False
+            self.condition.notify()
+        self.scheduler.stop()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+gather_queue = GatherQueue(gather_scheduler)
+
+class BatchedWindow:
+    def __init__(self, window):
+        self.window = window
+        self.stats_dirty = False
+        self.lines = {}
+        self.printed = {}
+
+    def write_event_value(self, key, value):
+        if key.endswith("-LOG-"):
+            return
+        if key == '-GATHER-STATS-':
+            self.stats_dirty = True
+            return
+        self.window.write_event_value(key, value)
 
-        wait_and_click("explore.png", must=True, delay=2)
-        wait_and_click("send.png", must=True, delay=1.5)
+    def clear(self, key):
+        self.flush()
+        self.lines[key] = deque(maxlen=GUI_LOG_LINES)
+        self.printed[key] = 0
+        self.window[key].update("")
 
-    window.write_event_value('-CLEARFOG-LOG-', "🛑 Đã dừng Clear Fog!")
+    def flush(self):
+        for key, lines in log_pipeline.drain().items():
+            recent = self.lines.setdefault(key, deque(maxlen=GUI_LOG_LINES))
+            recent.extend(lines)
+            self.printed[key] = self.printed.get(key, 0) + len(lines)
+            if self.printed[key] > 2 * GUI_LOG_LINES:
+                self.window[key].update("\n".join(recent) + "\n")
+                self.printed[key] = len(recent)
+            else:
+                self.window[key].print("\n".join(lines))
+        dirty, self.stats_dirty = self.stats_dirty, False
+        return dirty
 
 def create_main_window():
     sg.theme('DarkAmber')
@@ -518,9 +2375,11 @@ def create_main_window():
     
     gather_rss_column = [
         [sg.Text('Thu thập tài nguyên:', font=('Helvetica', 12, 'bold'))],
-        [sg.Text('Số đạo quân:'), sg.Input('6', size=(5, 1), key='-MARCHES-')],
+        [sg.Text('Số đạo quân:'), sg.Input('6', size=(5, 1), key='-MARCHES-'),
+         sg.Checkbox('Tự gửi lại khi quân về', default=True, key='-AUTO-GATHER-')],
         [sg.Button('Bắt đầu', key='-START-GATHER-'), 
          sg.Button('Dừng', key='-STOP-GATHER-', disabled=True)],
+        [sg.Text('', size=(60, 1), key='-GATHER-STATS-')],
         [sg.Multiline(size=(60, 10), key='-GATHER-LOG-', disabled=True, autoscroll=True)]
     ]
     
@@ -531,16 +2390,24 @@ def create_main_window():
         [sg.Multiline(size=(60, 10), key='-CLEARFOG-LOG-', disabled=True, autoscroll=True)]
     ]
     
+    device_stats_row = [
+        sg.Table(values=[], headings=['Thiết bị', 'Chờ (s)', 'Chụp màn hình (s)', 'So khớp (s)', 'Đạo quân/giờ'],
+                 key='-DEVICE-STATS-', num_rows=4, auto_size_columns=False, col_widths=[18, 10, 16, 12, 12],
+                 justification='right', expand_x=True)
+    ]
+    
     layout = [
         [sg.Column(device_list_column), sg.VSeparator(), sg.Column(game_control_column)],
         [sg.HSeparator()],
-        [sg.Column(gather_rss_column), sg.VSeparator(), sg.Column(clear_fog_column)]
+        [sg.Column(gather_rss_column), sg.VSeparator(), sg.Column(clear_fog_column)],
+        [sg.HSeparator()],
+        device_stats_row
     ]
     
     return sg.Window('ROK Tool 2025', layout, finalize=True, resizable=True)
 
-def update_device_list(window):
-    devices = list_devices()
+def update_device_list(window, max_age=None):
+    devices = list_devices(max_age)
     text = ""
     if not devices:
         text = "Không tìm thấy thiết bị nào!"
@@ -550,18 +2417,87 @@ def update_device_list(window):
             text += f"{i}. {device} - {icon} {status}\n"
     window['-DEVICE-LIST-'].update(text)
 
+def update_gather_stats(window):
+    window['-GATHER-STATS-'].update(
+        f"Đã gửi {gather_scheduler.marches()} đạo quân | "
+        f"{gather_scheduler.marches_per_hour():.1f} đạo quân/giờ | "
+        f"{len(gather_scheduler.active_devices())} thiết bị đang chạy"
+        + (f" | {gather_queue.pending()} thiết bị chờ quân về" if gather_queue.running() else ""))
+    update_device_stats(window)
+
+def update_device_stats(window):
+    rows = []
+    for scheduler in (gather_scheduler, clear_fog_scheduler):
+        for device_id, session in scheduler.sessions.items():
+            waiting, capturing, matching, per_hour = session.stats()
+            rows.append([device_id, f"{waiting:.1f}", f"{capturing:.1f}", f"{matching:.1f}", f"{per_hour:.1f}"])
+    window['-DEVICE-STATS-'].update(values=rows)
+    tracer.write_metrics()
+
+def select_devices(title, online_devices):
+    if len(online_devices) == 1:
+        return [online_devices[0][0]]
+
+    layout = [
+        [sg.Text(title)],
+        [sg.Listbox([f"{i}. {d[0]}" for i, d in enumerate(online_devices, 1)], 
+                  size=(50, min(10, len(online_devices))), key='-DEVICE-SELECTION-',
+                  select_mode=sg.LISTBOX_SELECT_MODE_MULTIPLE)],
+        [sg.Radio('Tất cả', "SELECT_OPTION", default=True, key='-ALL-'),
+         sg.Radio('Chọn thủ công', "SELECT_OPTION", key='-MANUAL-')],
+        [sg.Button('Bắt đầu'), sg.Button('Hủy')]
+    ]
+    
+    select_window = sg.Window('Chọn thiết bị', layout, modal=True)
+    device_ids = None
+    while True:
+        select_event, select_values = select_window.read()
+        if select_event in (sg.WINDOW_CLOSED, 'Hủy'):
+            break
+        elif select_event == 'Bắt đầu':
+            if select_values['-ALL-']:
+                device_ids = [d[0] for d in online_devices]
+            else:
+                selected = select_values['-DEVICE-SELECTION-']
+                if not selected:
+                    sg.popup("Vui lòng chọn ít nhất một thiết bị!")
+                    continue
+                device_ids = [online_devices[int(s.split('.')[0]) - 1][0] for s in selected]
+            break
+    select_window.close()
+    return device_ids
+
 def main():
+    global sg
+    import PySimpleGUI as sg
+    templates.load()
+    screen_index.load()
+    mine_levels.load()
     window = create_main_window()
-    gather_thread = None
-    clear_fog_thread_obj = None
+    batched = BatchedWindow(window)
+    stats_at = 0
+    device_manager.subscribe(lambda device_id, status: window.write_event_value('-DEVICE-STATUS-', device_id))
+    device_manager.start_monitor()
+    if METRICS_PORT:
+        metrics_server = tracer.serve_metrics(METRICS_PORT)
     
     while True:
-        event, values = window.read()
+        event, values = window.read(timeout=LOG_REFRESH_MS)
         
         if event == sg.WINDOW_CLOSED:
             break
             
+        elif event == sg.TIMEOUT_EVENT:
+            if batched.flush():
+                update_gather_stats(window)
+            if (gather_scheduler.sessions or clear_fog_scheduler.sessions) and time.time() - stats_at >= STATS_REFRESH:
+                update_device_stats(window)
+                stats_at = time.time()
+            
         elif event == '-REFRESH-DEVICES-':
+            update_device_list(window, max_age=0)
+            
+        elif event == '-DEVICE-STATUS-':
             update_device_list(window)
             
         elif event == '-CONNECT-DEVICES-':
@@ -595,14 +2531,16 @@ def main():
                         indices = [int(s.split('.')[0]) for s in selected]
                         selection = ",".join(map(str, indices))
                     
-                    results = connect_devices(selection, devices)
-                    for did, ok, msg in results:
-                        color = "green" if ok else "red"
-                        sg.popup(f"{did}: {msg}", title="Kết quả kết nối", text_color=color)
-                    update_device_list(window)
+                    window.perform_long_operation(lambda: connect_devices(selection, devices), '-CONNECT-DONE-')
                     break
             connect_window.close()
             
+        elif event == '-CONNECT-DONE-':
+            for did, ok, msg in values[event]:
+                color = "green" if ok else "red"
+                sg.popup(f"{did}: {msg}", title="Kết quả kết nối", text_color=color)
+            update_device_list(window)
+            
         elif event == '-DISCONNECT-DEVICES-':
             devices = list_devices()
             if not devices:
@@ -634,13 +2572,15 @@ def main():
                         indices = [int(s.split('.')[0]) for s in selected]
                         selection = ",".join(map(str, indices))
                     
-                    results = disconnect_devices(selection, devices)
-                    for did, ok, msg in results:
-                        sg.popup(f"{did}: {msg}", title="Kết quả ngắt kết nối")
-                    update_device_list(window)
+                    window.perform_long_operation(lambda: disconnect_devices(selection, devices), '-DISCONNECT-DONE-')
                     break
             disconnect_window.close()
             
+        elif event == '-DISCONNECT-DONE-':
+            for did, ok, msg in values[event]:
+                sg.popup(f"{did}: {msg}", title="Kết quả ngắt kết nối")
+            update_device_list(window)
+            
         elif event == '-LAUNCH-GAME-':
             devices = list_devices()
             if not devices:
@@ -648,8 +2588,7 @@ def main():
                 continue
                 
             package_name = "com.lilithgame.roc.gp" if values['-GLOBAL-'] else "com.rok.gp.vn"
-            result = launch_game("all", devices, package_name)
-            sg.popup(result)
+            window.perform_long_operation(lambda: launch_game("all", devices, package_name), '-GAME-DONE-')
             
         elif event == '-CLOSE-GAME-':
             devices = list_devices()
@@ -658,8 +2597,10 @@ def main():
                 continue
                 
             package_name = "com.lilithgame.roc.gp" if values['-GLOBAL-'] else "com.rok.gp.vn"
-            result = close_game("all", devices, package_name)
-            sg.popup(result)
+            window.perform_long_operation(lambda: close_game("all", devices, package_name), '-GAME-DONE-')
+            
+        elif event == '-GAME-DONE-':
+            sg.popup(values[event])
             
         elif event == '-START-GATHER-':
             devices = list_devices()
@@ -676,61 +2617,23 @@ def main():
                 sg.popup("Vui lòng nhập số đạo quân hợp lệ (số nguyên dương)!")
                 continue
                 
-            if len(online_devices) > 1:
-                layout = [
-                    [sg.Text('Chọn thiết bị để thu thập tài nguyên:')],
-                    [sg.Listbox([f"{i}. {d[0]}" for i, d in enumerate(online_devices, 1)], 
-                              size=(50, min(10, len(online_devices))), key='-DEVICE-SELECTION-')],
-                    [sg.Button('Bắt đầu'), sg.Button('Hủy')]
-                ]
-                
-                select_window = sg.Window('Chọn thiết bị', layout, modal=True)
-                while True:
-                    select_event, select_values = select_window.read()
-                    if select_event in (sg.WINDOW_CLOSED, 'Hủy'):
-                        break
-                    elif select_event == 'Bắt đầu':
-                        selected = select_values['-DEVICE-SELECTION-']
-                        if not selected:
-                            sg.popup("Vui lòng chọn ít nhất một thiết bị!")
-                            continue
-                        device_idx = int(selected[0].split('.')[0]) - 1
-                        device_id = online_devices[device_idx][0]
-                        
-                        window['-START-GATHER-'].update(disabled=True)
-                        window['-STOP-GATHER-'].update(disabled=False)
-                        window['-GATHER-LOG-'].update("")
-                        
-                        gather_thread = threading.Thread(
-                            target=gather_rss_thread,
-                            args=(device_id, window, max_marches),
-                            daemon=True
-                        )
-                        gather_thread.start()
-                        break
-                select_window.close()
-            else:
-                device_id = online_devices[0][0]
+            device_ids = select_devices('Chọn thiết bị để thu thập tài nguyên:', online_devices)
+            if device_ids:
                 window['-START-GATHER-'].update(disabled=True)
                 window['-STOP-GATHER-'].update(disabled=False)
-                window['-GATHER-LOG-'].update("")
-                
-                gather_thread = threading.Thread(
-                    target=gather_rss_thread,
-                    args=(device_id, window, max_marches),
-                    daemon=True
-                )
-                gather_thread.start()
+                batched.clear('-GATHER-LOG-')
+                window['-GATHER-STATS-'].update("")
+                if values['-AUTO-GATHER-']:
+                    gather_queue.start(device_ids, batched, '-GATHER-LOG-', max_marches)
+                else:
+                    gather_scheduler.start(device_ids, gather_rss_thread, batched, '-GATHER-LOG-', max_marches)
                 
         elif event == '-STOP-GATHER-':
-            global stop_gather_flag
-            stop_gather_flag = True
+            gather_queue.stop()
+            gather_scheduler.stop()
             window['-STOP-GATHER-'].update(disabled=True)
             window['-START-GATHER-'].update(disabled=False)
             
-        elif event == '-GATHER-LOG-':
-            window['-GATHER-LOG-'].print(values[event])
-            
         elif event == '-START-CLEARFOG-':
             devices = list_devices()
             online_devices = [d for d in devices if d[1] == "online"]
@@ -738,71 +2641,180 @@ def main():
                 sg.popup("Không có thiết bị nào đang online!")
                 continue
                 
-            if len(online_devices) > 1:
-                layout = [
-                    [sg.Text('Chọn thiết bị để Clear Fog:')],
-                    [sg.Listbox([f"{i}. {d[0]}" for i, d in enumerate(online_devices, 1)], 
-                              size=(50, min(10, len(online_devices))), key='-DEVICE-SELECTION-')],
-                    [sg.Button('Bắt đầu'), sg.Button('Hủy')]
-                ]
-                
-                select_window = sg.Window('Chọn thiết bị', layout, modal=True)
-                while True:
-                    select_event, select_values = select_window.read()
-                    if select_event in (sg.WINDOW_CLOSED, 'Hủy'):
-                        break
-                    elif select_event == 'Bắt đầu':
-                        selected = select_values['-DEVICE-SELECTION-']
-                        if not selected:
-                            sg.popup("Vui lòng chọn ít nhất một thiết bị!")
-                            continue
-                        device_idx = int(selected[0].split('.')[0]) - 1
-                        device_id = online_devices[device_idx][0]
-                        
-                        window['-START-CLEARFOG-'].update(disabled=True)
-                        window['-STOP-CLEARFOG-'].update(disabled=False)
-                        window['-CLEARFOG-LOG-'].update("")
-                        
-                        clear_fog_thread_obj = threading.Thread(
-                            target=clear_fog_thread,
-                            args=(device_id, window),
-                            daemon=True
-                        )
-                        clear_fog_thread_obj.start()
-                        break
-                select_window.close()
-            else:
-                device_id = online_devices[0][0]
+            device_ids = select_devices('Chọn thiết bị để Clear Fog:', online_devices)
+            if device_ids:
                 window['-START-CLEARFOG-'].update(disabled=True)
                 window['-STOP-CLEARFOG-'].update(disabled=False)
-                window['-CLEARFOG-LOG-'].update("")
-                
-                clear_fog_thread_obj = threading.Thread(
-                    target=clear_fog_thread,
-                    args=(device_id, window),
-                    daemon=True
-                )
-                clear_fog_thread_obj.start()
+                batched.clear('-CLEARFOG-LOG-')
+                clear_fog_scheduler.start(device_ids, clear_fog_thread, batched, '-CLEARFOG-LOG-')
                 
         elif event == '-STOP-CLEARFOG-':
-            global stop_clear_fog_flag
-            stop_clear_fog_flag = True
+            clear_fog_scheduler.stop()
             window['-STOP-CLEARFOG-'].update(disabled=True)
             window['-START-CLEARFOG-'].update(disabled=False)
             
-        elif event == '-CLEARFOG-LOG-':
-            window['-CLEARFOG-LOG-'].print(values[event])
     
+    gather_queue.stop()
+    gather_scheduler.stop()
+    clear_fog_scheduler.stop()
+    device_manager.stop()
+    close_screencap_streams()
+    close_input_sessions()
+    if METRICS_PORT:
+        metrics_server.shutdown()
+    tracer.write_metrics()
+    tracer.close()
+    log_pipeline.close()
+    resource_store.close()
+    screen_index.save()
+    window.close()
+
+class HeadlessWindow:
+    def __init__(self, path=HEADLESS_LOG_PATH, echo=True):
+        self.echo = echo
+        self.output = LogPipeline(path) if path else None
+        self.lock = threading.Lock()
+
+    def write_event_value(self, key, value):
+        record = {"ts": round(time.time(), 3), "event": key.strip("-").lower()}
+        if match := re.match(r"\[(\S+)\] (.*)", str(value), re.S):
+            record["device"], record["message"] = match.groups()
+        else:
+            record["device" if key in ('-GATHER-STATS-', '-DEVICE-STATUS-') else "message"] = value
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock:
+            if self.output is not None and not key.endswith("-LOG-"):
+                self.output.write(line + "\n")
+            if self.echo:
+                print(line, flush=True)
+
+    def close(self):
+        with self.lock:
+            if self.output is not None:
+                self.output.close()
+
+def load_config(path):
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    for job in config.get("jobs", []):
+        if job.get("flow") not in ("gather", "fog"):
+            raise ValueError(f"unknown flow: {job.get('flow')}")
+    return config
+
+def run_headless(config_path):
+    config = load_config(config_path)
+    window = HeadlessWindow(config.get("log", HEADLESS_LOG_PATH))
+    templates.load()
+    screen_index.load()
+    mine_levels.load()
+    device_manager.subscribe(lambda device_id, status: window.write_event_value('-DEVICE-STATUS-', f"[{device_id}] {status}"))
+    device_manager.start_monitor()
+    if port := config.get("metrics_port", METRICS_PORT):
+        metrics_server = tracer.serve_metrics(port)
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+
+    def wanted(devices):
+        selected = config.get("devices", "all")
+        return [d for d in devices if selected == "all" or d[0] in selected]
+
+    def connect_missing():
+        devices = list_devices(max_age=0)
+        indices = [str(i) for i, d in enumerate(devices, 1) if d in wanted(devices) and d[1] == "offline"]
+        if indices:
+            for device_id, ok, message in connect_devices(",".join(indices), devices):
+                window.write_event_value('-DEVICE-STATUS-', f"[{device_id}] {message}")
+
+    if config.get("connect", True):
+        connect_missing()
+    if package := config.get("launch"):
+        devices = list_devices()
+        indices = [str(i) for i, d in enumerate(devices, 1) if d in wanted(devices)]
+        window.write_event_value('-HEADLESS-', launch_game(",".join(indices), devices, package))
+        stop_event.wait(config.get("launch_wait", 60))
+
+    jobs = config.get("jobs", [])
+    next_run = [0.0] * len(jobs)
+    fog_deadline = None
+    reconnect_at = time.time() + HEADLESS_RECONNECT_INTERVAL
+    while not stop_event.is_set():
+        now = time.time()
+        if config.get("connect", True) and now >= reconnect_at:
+            connect_missing()
+            reconnect_at = now + HEADLESS_RECONNECT_INTERVAL
+        online = [d[0] for d in wanted(list_devices()) if d[1] == "online"]
+        for i, job in enumerate(jobs):
+            if now < next_run[i]:
+                continue
+            targets = [d for d in online if d in job.get("devices", online)]
+            if job["flow"] == "gather" and job.get("auto"):
+                gather_queue.start(targets, window, '-GATHER-LOG-', job.get("marches", 6))
+            elif job["flow"] == "gather":
+                gather_scheduler.start(targets, gather_rss_thread, window, '-GATHER-LOG-', job.get("marches", 6))
+            else:
+                clear_fog_scheduler.start(targets, clear_fog_thread, window, '-CLEARFOG-LOG-')
+                if job.get("duration"):
+                    fog_deadline = now + job["duration"]
+            next_run[i] = now + job["interval"] if job.get("interval") else float("inf")
+        if fog_deadline and now >= fog_deadline:
+            clear_fog_scheduler.stop()
+            fog_deadline = None
+        if all(t == float("inf") for t in next_run) and not fog_deadline and not (
+                gather_queue.running() or gather_scheduler.running() or clear_fog_scheduler.running()):
+            break
+        stop_event.wait(1)
+
+    gather_queue.stop()
+    gather_scheduler.stop()
+    clear_fog_scheduler.stop()
+    for scheduler in (gather_scheduler, clear_fog_scheduler):
+        for session in list(scheduler.sessions.values()):
+            session.thread.join(timeout=10)
+    device_manager.stop()
+    close_screencap_streams()
+    close_input_sessions()
+    if port:
+        metrics_server.shutdown()
+    tracer.write_metrics()
+    tracer.close()
+    log_pipeline.close()
+    resource_store.close()
+    screen_index.save()
+    window.write_event_value('-HEADLESS-', "stopped")
     window.close()
 
 if __name__ == "__main__":
-    REQUIRED_MODULES = ["rich", "pytesseract", "numpy", "opencv-python", "PySimpleGUI"]
+    if len(sys.argv) == 3 and sys.argv[1] == "--learn-regions":
+        for name, entry in learn_regions(sys.argv[2]).items():
+            print(f"{name}: {entry['region']}")
+        sys.exit(0)
+
+    if len(sys.argv) == 7 and sys.argv[1] == "--learn-glyphs":
+        image = cv2.imread(sys.argv[2])
+        print("Glyphs:", " ".join(glyphs.learn(Frame(image), sys.argv[3:])))
+        sys.exit(0)
+
+    if len(sys.argv) in (2, 3) and sys.argv[1] == "--resources":
+        for device_id in sys.argv[2:] or resource_store.devices():
+            if snapshot := resource_store.latest(device_id, float("inf")):
+                ts, resources = snapshot
+                print(f"{device_id} @ {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))}: {resources}")
+            if rates := resource_store.rates(device_id):
+                print("  24h/giờ: " + ", ".join(f"{key} {rate:+,.0f}" for key, rate in rates.items()))
+        sys.exit(0)
+
+    if len(sys.argv) == 3 and sys.argv[1] == "--headless":
+        run_headless(sys.argv[2])
+        sys.exit(0)
+
+    REQUIRED_MODULES = {"rich": "rich", "pytesseract": "pytesseract", "numpy": "numpy",
+                        "cv2": "opencv-python", "PySimpleGUI": "PySimpleGUI"}
     
-    for module in REQUIRED_MODULES:
-        try:
-            __import__(module.split("-")[0])
-        except ImportError:
-            print(f"[⚠️] ➜ Module '{module}' chưa có. Đang cài đặt...")
-            subprocess.check_call([sys.executable, "-m", "pip", "install", "--upgrade", module])
+    for module, package in REQUIRED_MODULES.items():
+        if importlib.util.find_spec(module) is None:
+            print(f"[⚠️] ➜ Module '{package}' chưa có. Đang cài đặt...")
+            subprocess.check_call([sys.executable, "-m", "pip", "install", "--upgrade", package])
     
     main()
\ No newline at end of file
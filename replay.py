@@ -0,0 +1,432 @@
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import asyncio
+import argparse
+import tempfile
+import threading
+import cv2
+import numpy as np
+import main
+
+SYNTHETIC_LATENCY = 0.3
+SYNTHETIC_POSITIONS = {
+    "home": (20, 445), "map": (20, 445), "find": (40, 330), "item": (860, 470),
+    "info": (300, 150), "exit": (880, 30), "food": (200, 300), "wood": (300, 300),
+    "stone": (400, 300), "gold": (500, 300), "up": (600, 420), "down": (400, 420),
+    "search": (420, 470), "gather": (400, 250), "newtroop": (760, 100), "march": (720, 460),
+    "1": (500, 200), "scout": (600, 250), "explore": (700, 400), "notselected": (300, 200),
+    "selected": (300, 200), "send": (700, 460),
+}
+SYNTHETIC_GATHER = {
+    "start": "world",
+    "resources": {"Food": "1.2M", "Wood": "850K", "Stone": "2.4M", "Gold": "600K"},
+    "states": {
+        "world": {"taps": {"home": "city", "find": "search_panel"}},
+        "city": {"taps": {"map": "world", "item": "bag"}},
+        "bag": {"taps": {"info": "resources", "exit": "city"}, "back": "city"},
+        "resources": {"taps": {"exit": "bag"}, "back": "bag"},
+        "search_panel": {"taps": {"food": "level", "wood": "level", "stone": "level", "gold": "level"},
+                         "back": "world"},
+        "level": {"taps": {"up": {"to": "level", "latency": 0}, "down": {"to": "level", "latency": 0},
+                           "search": "mine"}, "back": "world"},
+        "mine": {"taps": {"gather": "troops"}, "back": "world"},
+        "troops": {"taps": {"newtroop": "march_panel"}, "back": "world"},
+        "march_panel": {"taps": {"march": "world"}, "back": "troops"},
+    },
+}
+SYNTHETIC_FOG = {
+    "start": "city",
+    "states": {
+        "city": {"taps": {"map": "world", "1": "camp"}},
+        "world": {"taps": {"home": "city"}},
+        "camp": {"taps": {"scout": "scout_panel"}, "back": "city"},
+        "scout_panel": {"taps": {"explore": "select"}, "back": "city"},
+        "select": {"taps": {"notselected": "selected", "explore": "send_panel"}, "back": "scout_panel"},
+        "selected": {"taps": {"selected": "selected", "explore": "send_panel"}, "back": "scout_panel"},
+        "send_panel": {"taps": {"send": "city"}, "back": "select"},
+    },
+}
+
+class ScreenState:
+    def __init__(self, name, image, targets, back=None):
+        self.name = name
+        self.image = image
+        self.targets = targets
+        self.back = back
+
+    def target_at(self, x, y):
+        for name, (bx, by, bw, bh), next_state, latency in self.targets:
+            if bx <= x < bx + bw and by <= y < by + bh:
+                return name, next_state, latency
+        return None
+
+class Scenario:
+    def __init__(self, start, states, resources=None):
+        self.start = start
+        self.states = states
+        self.resources = resources
+
+    @staticmethod
+    def parse_target(entry, latency):
+        if isinstance(entry, str):
+            return entry, latency
+        return entry["to"], entry.get("latency", latency)
+
+    @classmethod
+    def load(cls, path, latency=SYNTHETIC_LATENCY):
+        with open(os.path.join(path, "scenario.json"), encoding="utf-8") as f:
+            spec = json.load(f)
+        latency = spec.get("latency", latency)
+        states = {}
+        for name, entry in spec["states"].items():
+            image = cv2.imread(os.path.join(path, entry["frame"]))
+            if image is None:
+                raise FileNotFoundError(entry["frame"])
+            frame = main.Frame(image)
+            targets = []
+            for template, target in entry.get("taps", {}).items():
+                hits = main.detect_all(frame, [template])
+                if not hits:
+                    print(f"[⚠️] {name}: không tìm thấy {template} trong {entry['frame']}")
+                    continue
+                next_state, delay = cls.parse_target(target, latency)
+                targets.append((template, hits[0].box, next_state, delay))
+            states[name] = ScreenState(name, image, targets, entry.get("back"))
+        return cls(spec["start"], states, spec.get("resources"))
+
+    @classmethod
+    def synthetic(cls, spec, latency=SYNTHETIC_LATENCY):
+        main.templates.load()
+        random = np.random.RandomState(0)
+        width, height = main.REFERENCE_SIZE
+        states = {}
+        for name, entry in spec["states"].items():
+            image = random.randint(0, 80, (height, width, 3)).astype(np.uint8)
+            targets = []
+            for template_name, target in entry["taps"].items():
+                template = main.templates.get(template_name)
+                x, y = SYNTHETIC_POSITIONS[template_name]
+                image[y:y + template.height, x:x + template.width] = template.color
+                next_state, delay = cls.parse_target(target, latency)
+                targets.append((template_name, (x, y, template.width, template.height), next_state, delay))
+            states[name] = ScreenState(name, image, targets, entry.get("back"))
+        return cls(spec["start"], states, spec.get("resources"))
+
+class FakeDevice:
+    def __init__(self, device_id, scenario, capture_latency=0.0):
+        self.device_id = device_id
+        self.scenario = scenario
+        self.capture_latency = capture_latency
+        self.state = scenario.start
+        self.pending = None
+        self.running = True
+        self.tap_counts = {}
+        self.captures = 0
+        self.lock = threading.Lock()
+
+    def current(self):
+        if self.pending and time.time() >= self.pending[0]:
+            self.state = self.pending[1]
+            self.pending = None
+        return self.scenario.states[self.state]
+
+    def screencap(self):
+        time.sleep(self.capture_latency)
+        with self.lock:
+            self.captures += 1
+            if not self.running:
+                return np.zeros_like(self.scenario.states[self.scenario.start].image)
+            return self.current().image
+
+    def tap(self, x, y):
+        with self.lock:
+            if not self.running or self.pending:
+                return
+            if target := self.current().target_at(x, y):
+                name, next_state, latency = target
+                self.tap_counts[name] = self.tap_counts.get(name, 0) + 1
+                if latency:
+                    self.pending = (time.time() + latency, next_state)
+                else:
+                    self.state = next_state
+
+    def back(self):
+        with self.lock:
+            if self.running and not self.pending and (back := self.current().back):
+                self.state = back
+
+    def launch(self):
+        with self.lock:
+            self.running = True
+            self.state = self.scenario.start
+            self.pending = None
+
+    def close(self):
+        with self.lock:
+            self.running = False
+
+class FakeAdb:
+    def __init__(self, scenario, count=1, capture_latency=0.0):
+        self.devices = {}
+        for i in range(count):
+            device_id = f"emulator-{5554 + i * 2}"
+            self.devices[device_id] = FakeDevice(device_id, scenario, capture_latency)
+
+    def command(self, args):
+        if args == ["devices"]:
+            lines = [f"{device_id}\tdevice" for device_id in self.devices]
+            return "List of devices attached\n" + "\n".join(lines) + "\n"
+        if args[0] == "connect":
+            return f"connected to {args[1]}\n"
+        if args[0] == "disconnect":
+            return f"disconnected {args[1]}\n"
+        if args[0] == "-s" and (device := self.devices.get(args[1])):
+            if args[2:4] == ["shell", "monkey"]:
+                device.launch()
+            elif args[2:5] == ["shell", "am", "force-stop"]:
+                device.close()
+            elif args[2:] == ["shell", "input", "keyevent", "4"]:
+                device.back()
+            elif args[2:] == ["get-state"]:
+                return "device\n" if device.running else "offline\n"
+        return ""
+
+    def screencap(self, device_id):
+        if device := self.devices.get(device_id):
+            return device.screencap()
+        return None
+
+    def tap_batch(self, device_id, points, interval=0):
+        device = self.devices.get(device_id)
+        for i, (x, y) in enumerate(points):
+            if i and interval:
+                time.sleep(interval)
+            if device:
+                device.tap(x, y)
+
+class AdbServer:
+    def __init__(self, backend, host="127.0.0.1"):
+        self.backend = backend
+        self.host = host
+        self.port = None
+        self.loop = None
+        self.server = None
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        def serve():
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, 0))
+            self.port = self.server.sockets[0].getsockname()[1]
+            ready.set()
+            self.loop.run_forever()
+        threading.Thread(target=serve, daemon=True).start()
+        ready.wait()
+        return self.port
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+
+    @staticmethod
+    def message(text):
+        payload = text.encode()
+        return b"%04x" % len(payload) + payload
+
+    async def read_request(self, reader):
+        length = int(await reader.readexactly(4), 16)
+        return (await reader.readexactly(length)).decode()
+
+    async def screencap(self, device):
+        image = await asyncio.get_event_loop().run_in_executor(None, device.screencap)
+        height, width = image.shape[:2]
+        return struct.pack("<III", width, height, 1) + cv2.cvtColor(image, cv2.COLOR_BGR2RGBA).tobytes()
+
+    async def handle(self, reader, writer):
+        try:
+            service = await self.read_request(reader)
+            if service == "host:devices":
+                lines = "".join(f"{device_id}\tdevice\n" for device_id in self.backend.devices)
+                writer.write(b"OKAY" + self.message(lines))
+            elif service.startswith(("host:connect:", "host:disconnect:")):
+                _, name, address = service.split(":", 2)
+                writer.write(b"OKAY" + self.message(self.backend.command([name, address]).strip()))
+            elif service.startswith("host-serial:") and service.endswith(":get-state"):
+                serial = service[len("host-serial:"):-len(":get-state")]
+                if serial not in self.backend.devices:
+                    writer.write(b"FAIL" + self.message(f"device '{serial}' not found"))
+                else:
+                    writer.write(b"OKAY" + self.message(self.backend.command(["-s", serial, "get-state"]).strip()))
+            elif service.startswith("host:transport:"):
+                device = self.backend.devices.get(service[len("host:transport:"):])
+                if device is None:
+                    writer.write(b"FAIL" + self.message("device not found"))
+                else:
+                    writer.write(b"OKAY")
+                    await self.transport(device, reader, writer)
+            else:
+                writer.write(b"FAIL" + self.message(f"unknown service {service}"))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def transport(self, device, reader, writer):
+        service = await self.read_request(reader)
+        if service == "shell,v2,raw:":
+            writer.write(b"OKAY")
+            await self.shell(device, reader, writer)
+        elif service == "exec:screencap":
+            writer.write(b"OKAY" + await self.screencap(device))
+        elif service.startswith("shell:"):
+            writer.write(b"OKAY")
+            writer.write(self.backend.command(["-s", device.device_id, "shell", *service[6:].split()]).encode())
+        else:
+            writer.write(b"FAIL" + self.message(f"unknown service {service}"))
+
+    async def shell(self, device, reader, writer):
+        def packet(packet_id, data):
+            return struct.pack("<BI", packet_id, len(data)) + data
+        pending = b""
+        while True:
+            packet_id, length = struct.unpack("<BI", await reader.readexactly(5))
+            data = await reader.readexactly(length)
+            if packet_id == 4:
+                writer.write(packet(3, b"\0"))
+                return
+            pending += data
+            while b"\n" in pending:
+                line, pending = pending.split(b"\n", 1)
+                for command in line.decode().split(";"):
+                    args = command.split()
+                    if args == ["screencap"]:
+                        writer.write(packet(1, await self.screencap(device)))
+                    elif args[:2] == ["input", "tap"]:
+                        device.tap(int(args[2]), int(args[3]))
+                    elif args[:1] == ["sleep"]:
+                        await asyncio.sleep(float(args[1]))
+                    elif args[:1] == ["echo"]:
+                        writer.write(packet(1, (" ".join(args[1:]) + "\n").encode()))
+                    elif args:
+                        output = self.backend.command(["-s", device.device_id, "shell", *args])
+                        writer.write(packet(1, output.encode()))
+                await writer.drain()
+
+class ConsoleWindow:
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+
+    def write_event_value(self, key, value):
+        if not self.quiet and key.endswith("-LOG-"):
+            print(value)
+
+original_ocr_resources_auto = main.ocr_resources_auto
+original_adb_client = main.adb_client
+original_stores = (main.resource_store, main.mine_levels, main.log_pipeline)
+adb_server = None
+state_path = None
+
+def install(scenario, count=1, capture_latency=0.0, protocol=False):
+    global adb_server, state_path
+    backend = FakeAdb(scenario, count, capture_latency)
+    main.device_backend = backend
+    state_path = tempfile.mkdtemp(prefix="rokbot-replay-")
+    main.resource_store = main.ResourceStore(os.path.join(state_path, "resources.db"))
+    main.mine_levels = main.MineLevels(os.path.join(state_path, "mine_levels.json"))
+    main.log_pipeline = main.LogPipeline(os.path.join(state_path, "logs.jsonl"))
+    if protocol:
+        adb_server = AdbServer(backend)
+        main.adb_client = main.AdbClient(port=adb_server.start())
+        main.device_backend = None
+    if scenario.resources:
+        main.ocr_resources_auto = lambda frame: dict(scenario.resources)
+    return backend
+
+def uninstall():
+    global adb_server, state_path
+    main.device_backend = None
+    main.ocr_resources_auto = original_ocr_resources_auto
+    main.resource_store.close()
+    main.log_pipeline.close()
+    main.resource_store, main.mine_levels, main.log_pipeline = original_stores
+    if state_path is not None:
+        shutil.rmtree(state_path, ignore_errors=True)
+        state_path = None
+    if adb_server is not None:
+        main.close_screencap_streams()
+        main.close_input_sessions()
+        main.adb_client.close()
+        main.adb_client = original_adb_client
+        adb_server.stop()
+        adb_server = None
+
+def replay_flow(scenario, flow="gather", devices=1, marches=3, duration=20, capture_latency=0.0, quiet=False,
+                protocol=False):
+    backend = install(scenario, devices, capture_latency, protocol)
+    window = ConsoleWindow(quiet)
+    scheduler = main.DeviceScheduler()
+
+    start = time.time()
+    if flow == "gather":
+        scheduler.start(list(backend.devices), main.gather_rss_thread, window, '-GATHER-LOG-', marches)
+        while scheduler.running():
+            time.sleep(0.1)
+    else:
+        scheduler.start(list(backend.devices), main.clear_fog_thread, window, '-CLEARFOG-LOG-')
+        time.sleep(duration)
+        scheduler.stop()
+        while scheduler.running():
+            time.sleep(0.1)
+    elapsed = time.time() - start
+    uninstall()
+
+    if flow == "gather":
+        done = scheduler.marches()
+        expected = marches * devices
+    else:
+        done = sum(device.tap_counts.get("send", 0) for device in backend.devices.values())
+        expected = 1
+    captures = sum(device.captures for device in backend.devices.values())
+    return {"done": done, "expected": expected, "elapsed": elapsed, "captures": captures}
+
+def run(args):
+    if args.scenario:
+        scenario = Scenario.load(args.scenario, args.latency)
+    else:
+        scenario = Scenario.synthetic(SYNTHETIC_GATHER if args.flow == "gather" else SYNTHETIC_FOG, args.latency)
+    if args.trace:
+        main.tracer.path = args.trace
+    result = replay_flow(scenario, args.flow, args.devices, args.marches, args.duration,
+                         args.capture_latency, args.quiet, args.protocol)
+    main.tracer.close()
+    if args.metrics:
+        main.tracer.write_metrics(args.metrics)
+    done, elapsed = result["done"], result["elapsed"]
+    unit, label = ("march", "marches") if args.flow == "gather" else ("scout", "scouts")
+    print(f"devices: {args.devices} | {label}: {done} | elapsed: {elapsed:.2f}s | captures: {result['captures']}")
+    if done:
+        print(f"time per {unit}: {elapsed * args.devices / done:.2f}s | {label} per hour: {done * 3600 / elapsed:.1f}")
+    return done >= result["expected"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay gather / clear fog against a fake ADB device")
+    parser.add_argument("--scenario", help="thư mục chứa scenario.json và ảnh màn hình (mặc định: kịch bản tổng hợp từ data/)")
+    parser.add_argument("--flow", choices=["gather", "fog"], default="gather")
+    parser.add_argument("--devices", type=int, default=1)
+    parser.add_argument("--marches", type=int, default=3)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--latency", type=float, default=SYNTHETIC_LATENCY)
+    parser.add_argument("--capture-latency", type=float, default=0.0)
+    parser.add_argument("--quiet", action="store_true")
+    parser.add_argument("--trace", help="ghi từng span ra file JSON lines")
+    parser.add_argument("--metrics", help="ghi số liệu dạng Prometheus ra file")
+    parser.add_argument("--protocol", action="store_true", help="đi qua giao thức ADB thật bằng một adb server giả lập")
+    sys.exit(0 if run(parser.parse_args()) else 1)